@@ -0,0 +1,202 @@
+""" Benchmark suite for ImageProcessor stages and end-to-end throughput
+
+Stage timings cover decode, _resize_image and route_image for every format
+ImageProcessor handles, at each of --sizes megapixels (RAW only for files
+given with --raw, timed through process_raw_image). The end-to-end part runs
+LLMProcessor through the pipeline against a local mock server once per
+--concurrency value, spread over --servers mock servers through the load
+balancer when there is more than one, and once per --batch-sizes value
+(images packed per request). Everything is printed as one JSON document so runs can
+be diffed between commits:
+
+    python benchmarks/benchmark.py --sizes 1 12 --images 64 --latency 0.3 --slots 8 --concurrency 1 4 8
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from mock_server import MockServer
+from samples import peak_rss_mb, percentiles, write_samples
+
+from image_processor import ImageProcessor
+from llmocr import LLMProcessor
+from load_balancer import Endpoint
+from pipeline import Pipeline
+
+
+def _timings(samples):
+    return {
+        "mean_ms": round(1000 * statistics.mean(samples), 2),
+        "min_ms": round(1000 * min(samples), 2),
+    }
+
+
+def _repeat(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_stages(samples, raw_files, max_dimension, repeat):
+    """ Time each ImageProcessor stage for every sample file """
+    processor = ImageProcessor(max_dimension=max_dimension)
+    results = {}
+    for (name, megapixels), path in samples.items():
+
+        def decode():
+            with processor._open_image(path) as img:
+                img.convert("RGB")
+
+        with processor._open_image(path) as img:
+            loaded = img.convert("RGB")
+        results.setdefault(name, {})[f"{megapixels:g}mp"] = {
+            "file_bytes": os.path.getsize(path),
+            "decode": _timings(_repeat(decode, repeat)),
+            "resize": _timings(_repeat(lambda: processor._resize_image(loaded), repeat)),
+            "route_image": _timings(_repeat(lambda: processor.route_image(path), repeat)),
+        }
+    for path in raw_files:
+        results.setdefault("RAW", {})[os.path.basename(path)] = {
+            "file_bytes": os.path.getsize(path),
+            "process_raw_image": _timings(_repeat(lambda: processor.process_raw_image(path), repeat)),
+        }
+    return results
+
+
+class TimedProcessor(LLMProcessor):
+    """ LLMProcessor that keeps the latency of every API request """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def _timed(self, method, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.latencies.append(time.perf_counter() - start)
+
+    def query(self, *args, **kwargs):
+        return self._timed(super().query, *args, **kwargs)
+
+    def query_batch(self, *args, **kwargs):
+        return self._timed(super().query_batch, *args, **kwargs)
+
+
+def bench_end_to_end(sample_path, images, latency, slots, concurrency, decode_workers,
+                     servers=1, error_rate=0.0, batch_size=1, image_latency=0.0):
+    """ Run `images` copies of a sample through the pipeline against mock servers """
+    mocks = [
+        MockServer(latency=latency, slots=slots, error_rate=error_rate, image_latency=image_latency).start()
+        for _ in range(servers)
+    ]
+    endpoints = [Endpoint(mock.url, weight=slots) for mock in mocks] if servers > 1 else None
+    directory = tempfile.mkdtemp()
+    try:
+        extension = os.path.splitext(sample_path)[1]
+        files = []
+        for i in range(images):
+            path = os.path.join(directory, f"image_{i:05d}{extension}")
+            shutil.copyfile(sample_path, path)
+            files.append(path)
+        processor = TimedProcessor(
+            mocks[0].url, "", "Transcribe any text on the image.", concurrency, endpoints=endpoints
+        )
+        processor.batch_size = batch_size
+        pipeline = Pipeline(processor, concurrency, decode_workers)
+        start = time.perf_counter()
+        pipeline.run(files)
+        elapsed = time.perf_counter() - start
+        processor.client.close()
+        latencies = {k: round(1000 * v, 1) if v is not None else None
+                     for k, v in percentiles(processor.latencies).items()}
+        result = {
+            "concurrency": concurrency,
+            "batch_size": batch_size,
+            "images": images,
+            "seconds": round(elapsed, 3),
+            "images_per_sec": round(images / elapsed, 2),
+            "request_latency_ms": latencies,
+            "stages": [stats.summary() for stats in pipeline.stats.values()],
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        if endpoints:
+            result["endpoints"] = [endpoint.summary() for endpoint in endpoints]
+        return result
+    finally:
+        for mock in mocks:
+            mock.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLMOCR benchmark suite")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 12], help="Synthetic image sizes in megapixels")
+    parser.add_argument("--max-dimension", type=int, default=896, help="ImageProcessor max_dimension")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage timing")
+    parser.add_argument("--raw", nargs="*", default=[], help="RAW files to time")
+    parser.add_argument("--skip-stages", action="store_true", help="Only run the end-to-end benchmark")
+    parser.add_argument("--images", type=int, default=32, help="Images per end-to-end run (0 to skip)")
+    parser.add_argument("--e2e-megapixels", type=float, default=4, help="Size of the end-to-end JPEG")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mock server seconds per request")
+    parser.add_argument("--slots", type=int, default=8, help="Mock server parallel slots")
+    parser.add_argument("--servers", type=int, default=1, help="Mock servers behind the load balancer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of mock requests failing with 503")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1], help="Images per request to compare")
+    parser.add_argument(
+        "--image-latency", type=float, default=0.0, help="Mock server extra seconds per additional image in a request"
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8], help="Values to compare")
+    parser.add_argument("--decode-workers", type=int, default=None, help="Pipeline decode processes")
+    parser.add_argument("--output", default=None, help="Write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    report = {
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "max_dimension": args.max_dimension,
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        if not args.skip_stages:
+            samples = {}
+            for megapixels in args.sizes:
+                for name, path in write_samples(directory, megapixels).items():
+                    samples[(name, megapixels)] = path
+            report["stages"] = bench_stages(samples, args.raw, args.max_dimension, args.repeat)
+        if args.images > 0:
+            e2e_sample = write_samples(directory, args.e2e_megapixels, formats=("JPEG",))["JPEG"]
+            report["end_to_end"] = {
+                "latency": args.latency,
+                "slots": args.slots,
+                "servers": args.servers,
+                "image_latency": args.image_latency,
+                "runs": [
+                    bench_end_to_end(e2e_sample, args.images, args.latency, args.slots,
+                                     concurrency, args.decode_workers, args.servers, args.error_rate,
+                                     batch_size, args.image_latency)
+                    for concurrency in args.concurrency
+                    for batch_size in args.batch_sizes
+                ],
+            }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+""" Compare full and fast (reduced resolution) decoding per image format
+
+Each case runs in a fresh process so its peak RSS is not polluted by the
+others. RAW files cannot be synthesised; pass real ones with --raw.
+
+    python benchmarks/decode_benchmark.py --megapixels 24 --repeat 3
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from samples import peak_rss_mb, write_samples
+
+
+def run_case(path, fast_decode, repeat, max_dimension, results):
+    try:
+        from image_processor import ImageProcessor
+        processor = ImageProcessor(max_dimension=max_dimension, fast_decode=fast_decode)
+        baseline = peak_rss_mb()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            processor.route_image(path)
+            times.append(time.perf_counter() - start)
+        results.put({"seconds": min(times), "peak_rss_mb": peak_rss_mb(), "baseline_rss_mb": baseline})
+    except Exception as e:
+        results.put({"error": str(e)})
+
+
+def measure(path, fast_decode, repeat, max_dimension):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_case, args=(path, fast_decode, repeat, max_dimension, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Full vs fast decode benchmark")
+    parser.add_argument("--megapixels", type=float, default=24, help="Size of the synthetic images")
+    parser.add_argument("--max-dimension", type=int, default=896, help="ImageProcessor max_dimension")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the fastest is kept")
+    parser.add_argument("--raw", nargs="*", default=[], help="RAW files to include")
+    parser.add_argument("--output", default=None, help="Write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    report = {"megapixels": args.megapixels, "max_dimension": args.max_dimension, "formats": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        samples = write_samples(directory, args.megapixels, formats=("JPEG", "PNG", "TIFF", "WEBP", "JPEG2000", "HEIF"))
+        for raw_path in args.raw:
+            samples[f"RAW:{os.path.basename(raw_path)}"] = raw_path
+        for name, path in samples.items():
+            full = measure(path, False, args.repeat, args.max_dimension)
+            fast = measure(path, True, args.repeat, args.max_dimension)
+            if "error" in full or "error" in fast:
+                report["formats"][name] = {"full": full, "fast": fast}
+                print(f"{name:>10}: failed", file=sys.stderr)
+                continue
+            entry = {"file_bytes": os.path.getsize(path), "full": full, "fast": fast,
+                     "speedup": round(full["seconds"] / fast["seconds"], 2) if fast["seconds"] else None}
+            if full["peak_rss_mb"] is not None:
+                entry["rss_saved_mb"] = round(full["peak_rss_mb"] - fast["peak_rss_mb"], 1)
+            report["formats"][name] = entry
+            print(f"{name:>10}: full {full['seconds']:.3f}s, fast {fast['seconds']:.3f}s", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
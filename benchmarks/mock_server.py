@@ -0,0 +1,198 @@
+""" Stand-in for an OpenAI compatible /v1/chat/completions server
+
+Answers every request with a fixed transcription after a configurable delay,
+streamed word by word (token_latency apart) when the request asks for
+stream. With loop the text repeats until max_tokens, like a model stuck
+in a repetition loop; max_tokens and stop are honoured. A share of
+requests (error_rate) can be answered with 503 to exercise failover.
+A request with several images takes image_latency longer per extra image
+and gets one "### Image N" answer per image, unless malformed_batches is
+set to test the single-image fallback.
+`slots` requests are served at once and the rest wait, like
+KoboldCpp with `multiuser` set. Run standalone or start one in-process from
+a benchmark:
+
+    python benchmarks/mock_server.py --port 5001 --latency 0.5 --slots 8
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.2,
+                 slots: int = 1, text: str = "Mock transcription of the image.",
+                 token_latency: float = 0.0, loop: bool = False, error_rate: float = 0.0,
+                 image_latency: float = 0.0, malformed_batches: bool = False):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.text = text
+        self.loop = loop
+        self.error_rate = error_rate
+        self.image_latency = image_latency
+        self.malformed_batches = malformed_batches
+        self.errors = 0
+        self.slots = threading.Semaphore(slots)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, payload):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for event in server.stream_events(payload):
+                        data = f"data: {event}\n\n".encode()
+                        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                        self.wfile.flush()
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stopped reading, e.g. an early stop
+                    self.close_connection = True
+
+            def do_GET(self):
+                if self.path == "/v1/models":
+                    self._send_json(200, {"object": "list", "data": [{"id": "mock-model", "object": "model"}]})
+                else:
+                    self._send_json(404, {"error": "not found"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                if self.path != "/v1/chat/completions":
+                    self._send_json(404, {"error": "not found"})
+                    return
+                if server.error_rate and random.random() < server.error_rate:
+                    with server._lock:
+                        server.errors += 1
+                    self._send_json(503, {"error": "overloaded"})
+                    return
+                with server.slots:
+                    time.sleep(server.latency + server.image_latency * max(0, server.images(payload) - 1))
+                    with server._lock:
+                        server.requests += 1
+                    if payload.get("stream"):
+                        self._send_stream(payload)
+                    else:
+                        self._send_json(200, server.completion(payload))
+
+        return Handler
+
+    @staticmethod
+    def images(payload: dict) -> int:
+        count = 0
+        for message in payload.get("messages", []):
+            if isinstance(message.get("content"), list):
+                count += sum(1 for part in message["content"] if part.get("type") == "image_url")
+        return count
+
+    def answer(self, payload: dict) -> str:
+        images = self.images(payload)
+        if images < 2 or self.malformed_batches:
+            return self.text
+        return "\n\n".join(f"### Image {number}\n{self.text}" for number in range(1, images + 1))
+
+    def words(self, payload: dict):
+        """ The answer's words and finish_reason, cut by max_tokens and stop """
+        max_tokens = payload.get("max_tokens") or 2048
+        words = self.answer(payload).split(" ")
+        if self.loop:
+            words = (words * (max_tokens // len(words) + 1))[:max_tokens]
+        finish_reason = "length" if len(words) >= max_tokens else "stop"
+        words = words[:max_tokens]
+        stop = payload.get("stop") or []
+        text = " ".join(words)
+        cuts = [text.find(s) for s in ([stop] if isinstance(stop, str) else stop) if s in text]
+        if cuts:
+            return text[:min(cuts)].rstrip().split(" "), "stop"
+        return words, finish_reason
+
+    def completion(self, payload: dict) -> dict:
+        words, finish_reason = self.words(payload)
+        return {
+            "object": "chat.completion",
+            "model": "mock-model",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": " ".join(words)},
+                "finish_reason": finish_reason,
+            }],
+            "usage": {"completion_tokens": len(words)},
+        }
+
+    def stream_events(self, payload: dict):
+        """ Yield SSE data lines, one word per event """
+        words, finish_reason = self.words(payload)
+        for i, word in enumerate(words):
+            if i and self.token_latency:
+                time.sleep(self.token_latency)
+            chunk = {"object": "chat.completion.chunk", "choices": [{
+                "index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None,
+            }]}
+            yield json.dumps(chunk)
+        yield json.dumps({"object": "chat.completion.chunk", "choices": [{
+            "index": 0, "delta": {}, "finish_reason": finish_reason,
+        }]})
+        yield "[DONE]"
+
+    def start(self) -> "MockServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI compatible vision server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per request")
+    parser.add_argument("--slots", type=int, default=1, help="Requests served in parallel")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds between streamed tokens")
+    parser.add_argument("--text", default="Mock transcription of the image.", help="Answer to every request")
+    parser.add_argument("--loop", action="store_true", help="Repeat the answer until max_tokens")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--image-latency", type=float, default=0.0, help="Extra seconds per additional image")
+    parser.add_argument("--malformed-batches", action="store_true", help="Answer multi-image requests undelimited")
+    args = parser.parse_args()
+    server = MockServer(args.host, args.port, args.latency, args.slots, args.text,
+                        token_latency=args.token_latency, loop=args.loop, error_rate=args.error_rate,
+                        image_latency=args.image_latency, malformed_batches=args.malformed_batches)
+    print(f"Serving on {server.url}")
+    server.httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+""" Helpers shared by the benchmarks: synthetic images and memory readings """
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from metrics import percentiles
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MB, None where unsupported """
+    # ru_maxrss survives exec on Linux and would include the parent's peak,
+    # VmHWM belongs to this process image only
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def make_image(width, height):
+    """ Text-like test page: dark strokes on a light, slightly noisy background """
+    from PIL import Image, ImageDraw
+    img = Image.effect_noise((width, height), 12).convert("RGB")
+    img = Image.blend(Image.new("RGB", img.size, "white"), img, 0.15)
+    draw = ImageDraw.Draw(img)
+    line_height = max(12, height // 80)
+    for y in range(line_height, height - line_height, line_height * 2):
+        draw.rectangle((width // 20, y, width - width // 20, y + line_height // 2), fill=(30, 30, 30))
+    return img
+
+
+def write_samples(directory, megapixels, formats=None):
+    """ Write one sample per format that this Pillow build can encode
+
+    Returns {format name: path}. RAW cannot be written and is never included.
+    """
+    from PIL import features
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    img = make_image(width, height)
+    samples = {
+        "JPEG": ("jpg", {"quality": 90}),
+        "PNG": ("png", {}),
+        "GIF": ("gif", {}),
+        "TIFF": ("tif", {}),
+        "WEBP": ("webp", {"quality": 90}),
+    }
+    if features.check("jpg_2000"):
+        samples["JPEG2000"] = ("jp2", {"irreversible": True})
+    try:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+        samples["HEIF"] = ("heic", {"quality": 90})
+    except ImportError:
+        pass
+    paths = {}
+    for name, (extension, options) in samples.items():
+        if formats and name not in formats:
+            continue
+        path = os.path.join(directory, f"sample_{megapixels:g}mp.{extension}")
+        img.save(path, **options)
+        paths[name] = path
+    return paths
@@ -0,0 +1,231 @@
+import json
+import socket
+import threading
+import time
+import weakref
+from typing import Iterator, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+# Connect time of the most recent new connection on this thread, and the
+# ApiClient sending from it
+_timing = threading.local()
+
+
+def _opened(connection, start: float):
+    _timing.connect = time.perf_counter() - start
+    client = getattr(_timing, "client", None)
+    if client is not None:
+        with client._lock:
+            client._connections.add(connection)
+
+
+def _stale_connection(error: Exception) -> bool:
+    """ Whether a request failed because the server had already closed the
+    pooled connection it went out on, before any response arrived
+    """
+    if not isinstance(error, requests.ConnectionError) or isinstance(error, requests.Timeout):
+        return False
+    if _timing.connect > 0:
+        return False
+    seen = error
+    while seen is not None:
+        if isinstance(seen, (ConnectionResetError, BrokenPipeError)):
+            return True
+        seen = seen.__cause__ or seen.__context__
+    return False
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _opened(self, start)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _opened(self, start)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedAdapter(HTTPAdapter):
+    """ HTTPAdapter whose connections record how long connect (and TLS) took
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+class ApiClient:
+    """ Keep-alive client for an OpenAI compatible API
+
+    One session is shared by all request threads. Its connection pool is sized
+    to the concurrency level so every in-flight request can reuse a connection.
+    429/503 responses and failed connects are retried with exponential
+    backoff. A request is never sent again once it may have reached the
+    server, since a read timeout usually means the model is still working
+    on it; the one exception is a reused keep-alive connection the server
+    had already closed, which is sent once more on a fresh connection.
+    abort() cuts off every request in flight from another thread.
+    """
+    def __init__(self, api_url: str, api_password: str = "", pool_size: int = 1,
+                 connect_timeout: float = 10.0, read_timeout: float = 300.0,
+                 retries: int = 3, backoff: float = 0.5):
+        self.api_url = api_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers["Content-Type"] = "application/json"
+        if api_password:
+            self.session.headers["Authorization"] = f"Bearer {api_password}"
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            # Re-raise read errors (timeouts included) as they are
+            read=False,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 503),
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        adapter = _TimedAdapter(pool_connections=1, pool_maxsize=max(1, pool_size), max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.requests = 0
+        self.connections = 0
+        self.connect_time = 0.0
+        self.ttfb_time = 0.0
+        self._lock = threading.Lock()
+        # Every connection this client opened, so abort() can shut them down
+        self._connections = weakref.WeakSet()
+        self._aborts = 0
+
+    def abort(self):
+        """ Cut off every request in flight, also ones still waiting for the
+        server's first byte
+
+        Shutting their connections down frees the server's slots. The requests
+        raise RuntimeError("cancelled"). Idle pooled connections go as well
+        and are reopened by the next request.
+        """
+        with self._lock:
+            self._aborts += 1
+            connections = list(self._connections)
+        for connection in connections:
+            sock = connection.sock
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _send(self, path: str, payload: dict, stream: bool = False) -> Tuple[requests.Response, int]:
+        """ POST payload, returning the response and the abort() count it
+            was sent under
+        """
+        url = f"{self.api_url}{path}"
+        aborts = self._aborts
+        _timing.client = self
+        for attempt in range(2):
+            _timing.connect = 0.0
+            try:
+                return self.session.post(url, json=payload, timeout=self.timeout, stream=stream), aborts
+            except requests.RequestException as e:
+                if self._aborts != aborts:
+                    raise RuntimeError("cancelled") from e
+                if attempt or not _stale_connection(e):
+                    raise
+
+    def post(self, path: str, payload: dict) -> Tuple[dict, dict]:
+        """ POST payload as JSON and return (response json, timings)
+
+        timings has connect (0.0 when a pooled connection was reused), ttfb
+        (request sent to response headers) and total, all in seconds.
+        """
+        start = time.perf_counter()
+        response, _ = self._send(path, payload)
+        response.raise_for_status()
+        response_json = response.json()
+        timings = {
+            "connect": _timing.connect,
+            "ttfb": response.elapsed.total_seconds(),
+            "total": time.perf_counter() - start,
+        }
+        with self._lock:
+            self.requests += 1
+            self.connections += int(timings["connect"] > 0)
+            self.connect_time += timings["connect"]
+            self.ttfb_time += timings["ttfb"]
+        return response_json, timings
+
+    def stream(self, path: str, payload: dict, timings: Optional[dict] = None) -> Iterator[dict]:
+        """ POST payload with stream enabled and yield each server-sent event
+        
+        Closing the generator early closes the connection, which stops the
+        server generating. timings, if given, receives connect and ttfb.
+        """
+        response, aborts = self._send(path, dict(payload, stream=True), stream=True)
+        try:
+            response.raise_for_status()
+            connect, ttfb = _timing.connect, response.elapsed.total_seconds()
+            if timings is not None:
+                timings.update({"connect": connect, "ttfb": ttfb})
+            with self._lock:
+                self.requests += 1
+                self.connections += int(connect > 0)
+                self.connect_time += connect
+                self.ttfb_time += ttfb
+            response.encoding = "utf-8"
+            try:
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        return
+                    yield json.loads(data)
+            except requests.RequestException as e:
+                if self._aborts != aborts:
+                    raise RuntimeError("cancelled") from e
+                raise
+            # A stream cut off by abort() can also just end
+            if self._aborts != aborts:
+                raise RuntimeError("cancelled")
+        finally:
+            response.close()
+
+    def get(self, path: str) -> dict:
+        _timing.client = self
+        response = self.session.get(f"{self.api_url}{path}", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.session.close()
+
+    def report(self) -> str:
+        with self._lock:
+            if not self.requests:
+                return "     api: no requests"
+            return (
+                f"     api: {self.requests} requests over {self.connections} connections, "
+                f"connect {1000 * self.connect_time:.1f} ms total, "
+                f"mean ttfb {1000 * self.ttfb_time / self.requests:.1f} ms"
+            )
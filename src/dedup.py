@@ -0,0 +1,175 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+
+# Gray levels two fingerprint pixels may differ by and still agree
+PIXEL_TOLERANCE = 32
+# Share of the content pixels (those off the background in either image)
+# that may disagree between two images of the same thing
+CONTENT_TOLERANCE = 0.05
+
+
+def hamming(a: str, b: str) -> int:
+    """ Number of differing bits between two hex hashes
+    """
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def same_content(a: bytes, b: bytes) -> bool:
+    """ Whether two ImageProcessor.fingerprint thumbnails show the same thing
+
+    Only pixels off the background count, so a few lines of different text
+    on a white page are told apart although most of the page agrees.
+    """
+    if len(a) != len(b):
+        return False
+    # Imported here so runs without dedup do not pay for NumPy
+    import numpy as np
+    x = np.frombuffer(a, dtype=np.uint8).astype(np.int16)
+    y = np.frombuffer(b, dtype=np.uint8).astype(np.int16)
+    content = (
+        (np.abs(x - int(np.median(x))) > PIXEL_TOLERANCE) | (np.abs(y - int(np.median(y))) > PIXEL_TOLERANCE)
+    )
+    differing = np.count_nonzero(np.abs(x - y) > PIXEL_TOLERANCE)
+    return differing <= CONTENT_TOLERANCE * np.count_nonzero(content)
+
+
+class Cluster:
+    """ Images whose hashes are within the threshold of the first one seen
+
+    The first member (the leader) is sent to the model; the others wait for
+    its result.
+    """
+    def __init__(self, phash: str, fingerprint: Optional[bytes], source: str, result: Optional[str] = None):
+        self.phash = phash
+        self.fingerprint = fingerprint
+        self.source = source
+        self.result = result
+        self.members = 1
+        self._done = threading.Event()
+        if result is not None:
+            self._done.set()
+
+    def resolve(self, result: Optional[str]):
+        self.result = result
+        self._done.set()
+
+    def wait(self) -> Optional[str]:
+        self._done.wait()
+        return self.result
+
+
+class DuplicateIndex:
+    """ Perceptual hash index that lets near-duplicate images share one answer
+
+    Hashes and fingerprints come from ImageProcessor(perceptual_hash=True).
+    An image within `threshold` bits of one already seen joins its cluster
+    if their fingerprints also show the same content, both inside a batch
+    and, when a path is given, against results stored by earlier runs in a
+    SQLite file. The hash alone is not enough: pages of text lines in the
+    same layout hash alike whatever the text says. Hashes within the
+    threshold of a uniform one (blank or nearly blank pages) carry too
+    little to go on and are never matched. Stored results are kept per
+    settings key, so a different instruction or model never reuses them.
+    Lookups scan every hash for the settings, which stays fast up to a few
+    hundred thousand images.
+    """
+    def __init__(self, path: Optional[str] = None, threshold: int = 10):
+        self.path = path
+        self.threshold = threshold
+        self._clusters = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS hashes ("
+                "settings TEXT NOT NULL, hash TEXT NOT NULL, path TEXT NOT NULL, "
+                "text TEXT NOT NULL, created REAL NOT NULL, fingerprint BLOB, PRIMARY KEY (settings, hash))"
+            )
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(hashes)")]
+            if "fingerprint" not in columns:
+                # Indexes from before fingerprints; their old rows never match
+                self._conn.execute("ALTER TABLE hashes ADD COLUMN fingerprint BLOB")
+            self._conn.commit()
+
+    @staticmethod
+    def settings_key(settings: dict) -> str:
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+    def _load(self, settings_key: str) -> list:
+        clusters = self._clusters.get(settings_key)
+        if clusters is None:
+            clusters = []
+            if self._conn:
+                rows = self._conn.execute(
+                    "SELECT hash, fingerprint, path, text FROM hashes WHERE settings = ?", (settings_key,)
+                ).fetchall()
+                clusters = [
+                    Cluster(phash, fingerprint, path, text) for phash, fingerprint, path, text in rows
+                ]
+            self._clusters[settings_key] = clusters
+        return clusters
+
+    def claim(self, phash: str, fingerprint: bytes, settings_key: str,
+              file_path) -> Tuple[Optional[Cluster], bool]:
+        """ Find the cluster for a hash, returning (cluster, is_leader)
+
+        A leader must call resolve() with its result, or None if it failed,
+        so waiting members can go on. An image that can not be matched gets
+        no cluster and is simply sent.
+        """
+        bits = bin(int(phash, 16)).count("1")
+        if min(bits, 4 * len(phash) - bits) <= self.threshold:
+            return None, True
+        with self._lock:
+            clusters = self._load(settings_key)
+            candidates = []
+            for cluster in clusters:
+                distance = hamming(phash, cluster.phash)
+                if distance <= self.threshold:
+                    candidates.append((distance, cluster))
+            candidates.sort(key=lambda candidate: candidate[0])
+            for _, cluster in candidates:
+                if cluster.fingerprint and same_content(fingerprint, cluster.fingerprint):
+                    cluster.members += 1
+                    return cluster, False
+            cluster = Cluster(phash, fingerprint, str(file_path))
+            clusters.append(cluster)
+            return cluster, True
+
+    def resolve(self, cluster: Cluster, result: Optional[str], settings_key: str):
+        """ Hand a leader's result to its cluster and store it for later runs
+
+        If the result can not be stored the cluster is given up, so its
+        members send their own requests, and the error is raised.
+        """
+        error = None
+        with self._lock:
+            if result is not None and self._conn:
+                try:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO hashes (settings, hash, path, text, created, fingerprint) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (settings_key, cluster.phash, cluster.source, result, time.time(), cluster.fingerprint)
+                    )
+                    self._conn.commit()
+                except sqlite3.Error as e:
+                    error = e
+                    result = None
+            if result is None:
+                # Let the next member that arrives try again
+                self._clusters[settings_key].remove(cluster)
+        cluster.resolve(result)
+        if error:
+            raise error
+
+    def close(self):
+        if self._conn:
+            with self._lock:
+                self._conn.close()
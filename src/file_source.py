@@ -0,0 +1,65 @@
+import glob
+import os
+from typing import IO, Iterable, Iterator, Optional
+
+
+def read_paths(stream: IO[str], null: bool = False) -> Iterator[str]:
+    """ Lazily yield newline or NUL delimited paths from a text stream
+    """
+    if not null:
+        for line in stream:
+            line = line.rstrip("\r\n")
+            if line:
+                yield line
+        return
+    buffer = ""
+    for chunk in iter(lambda: stream.read(64 * 1024), ""):
+        buffer += chunk
+        *paths, buffer = buffer.split("\0")
+        for path in paths:
+            if path:
+                yield path
+    if buffer:
+        yield buffer
+
+
+def expand_path(source: str, recursive: bool = True) -> Iterator[str]:
+    """ Yield the files named by a path, directory or glob pattern
+    """
+    if os.path.isdir(source):
+        if not recursive:
+            for entry in sorted(os.scandir(source), key=lambda e: e.name):
+                if entry.is_file():
+                    yield entry.path
+            return
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                yield os.path.join(root, name)
+    elif glob.has_magic(source):
+        for path in glob.iglob(source, recursive=recursive):
+            if os.path.isdir(path):
+                yield from expand_path(path, recursive)
+            else:
+                yield path
+    else:
+        yield source
+
+
+def iter_files(sources: Iterable[str], image_processor, recursive: bool = True,
+               stdin: Optional[IO[str]] = None, null: bool = False) -> Iterator[str]:
+    """ Yield image files from paths, directories, globs and optionally stdin
+
+    Nothing is collected up front, so processing can start on the first file
+    and memory does not grow with the size of the corpus. Files whose extension
+    ImageProcessor does not handle are skipped.
+    """
+    def all_sources():
+        yield from sources
+        if stdin is not None:
+            yield from read_paths(stdin, null)
+
+    for source in all_sources():
+        for path in expand_path(source, recursive):
+            if image_processor._get_image_type(path) is not None:
+                yield path
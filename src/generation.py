@@ -0,0 +1,93 @@
+import os
+from typing import Optional
+
+
+def token_budget(max_length: int, info: Optional[dict] = None, previous: Optional[str] = None,
+                 min_tokens: int = 128) -> int:
+    """ Pick max_tokens for one image instead of always asking for max_length
+
+    A previous transcription of the same file is the best guess, otherwise
+    the number of characters ImageProcessor(measure_text=True) estimated on
+    the image: about 3 characters per token, plus half again. An answer that
+    still runs out of this budget is asked for again with the full one.
+    """
+    if previous:
+        characters = len(previous)
+    elif info and "characters" in info:
+        characters = info["characters"]
+    else:
+        return max_length
+    budget = int(characters / 3 * 1.5) + 64
+    return max(min_tokens, min(max_length, budget))
+
+
+def previous_result(output_path) -> Optional[str]:
+    """ Text of an existing .txt sidecar, if there is one
+    """
+    try:
+        with open(os.path.splitext(str(output_path))[0] + ".txt", "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class RepetitionDetector:
+    """ Spot a model stuck in a loop while its output streams in
+
+    Text is flagged once its tail is the same unit of min_period..max_period
+    characters repeated `repeats` times in a row, e.g. one line over and over.
+    Short units must also cover min_span characters so dot leaders and wide
+    table rules are not mistaken for a loop. Checks run every `interval`
+    characters so the cost stays small.
+    """
+    def __init__(self, repeats: int = 4, min_period: int = 8, max_period: int = 200,
+                 min_span: int = 160, interval: int = 32):
+        self.repeats = repeats
+        self.min_period = min_period
+        self.max_period = max_period
+        self.min_span = min_span
+        self.interval = interval
+        self.text = ""
+        self.period = None
+        self._checked = 0
+
+    def feed(self, text: str) -> bool:
+        """ Add streamed text; True once the output is looping
+        """
+        self.text += text
+        if self.period is not None:
+            return True
+        if len(self.text) - self._checked < self.interval:
+            return False
+        self._checked = len(self.text)
+        tail = self.text[-max(self.max_period * self.repeats, self.min_span + self.max_period):]
+        for period in range(self.min_period, min(self.max_period, len(tail) // self.repeats) + 1):
+            unit = tail[-period:]
+            if not unit.strip():
+                continue
+            copies = max(self.repeats, -(-self.min_span // period))
+            if tail.endswith(unit * copies):
+                self.period = period
+                return True
+        return False
+
+    def trimmed(self) -> str:
+        """ The text with all but the first copy of the repeated unit removed
+        """
+        if self.period is None:
+            return self.text
+        text = self.text
+        unit = text[-self.period:]
+        while text.endswith(unit + unit):
+            text = text[:-self.period]
+        return text
+
+
+def tokens_saved(max_length: int, generated: int, aborted: bool = False) -> int:
+    """ Tokens not generated compared with always allowing max_length
+
+    Only a stream closed early, on a loop or a stop sequence, saved anything:
+    the rest of max_length. An answer that ran out of tokens was truncated,
+    not shortened, and never counts.
+    """
+    return max(0, max_length - generated) if aborted else 0
@@ -2,23 +2,90 @@ import base64
 import io 
 import math
 import os
+import threading
+import time
 from pathlib import Path
 from typing import Optional, Tuple, Union, List
-import rawpy
-from PIL import Image
-from pillow_heif import register_heif_opener
+from PIL import Image, ImageFilter
+from raw_cache import RawCache
+from triage import Triage
+
+# rawpy (with NumPy), pillow_heif and pypdfium2 are imported the first time
+# a file of their format is read, so starting up stays quick
+
+# PDFium is not thread safe; decode threads take turns rendering
+_pdf_lock = threading.Lock()
+_heif_registered = False
+
+def _register_heif():
+    """ Let Pillow open HEIF/HEIC files, once per process """
+    global _heif_registered
+    if not _heif_registered:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+        _heif_registered = True
 
 class ImageProcessor:
     def __init__(self, max_dimension: int = 1280,
                  patch_sizes: Optional[List[int]] = None,
-                 max_file_size: int = 50 * 1024 * 1024):
+                 max_file_size: int = 50 * 1024 * 1024,
+                 fast_decode: bool = True,
+                 sizing: str = "fixed",
+                 patch_size: Optional[int] = None,
+                 token_budget: Optional[int] = None,
+                 adaptive: bool = False,
+                 encoding: str = "jpeg",
+                 jpeg_quality: int = 95,
+                 passthrough: bool = True,
+                 measure_text: bool = False,
+                 fast_demosaic: bool = False,
+                 raw_cache: Optional[RawCache] = None,
+                 perceptual_hash: bool = False,
+                 multipage: bool = True,
+                 triage: Optional[Triage] = None):
         
         if max_dimension <= 0:
             raise ValueError("max_dimension must be positive")
+        if sizing not in ("fixed", "budget"):
+            raise ValueError("sizing must be 'fixed' or 'budget'")
+        if encoding not in self.encodings:
+            raise ValueError(f"encoding must be one of {', '.join(self.encodings)}")
         self.max_dimension = max_dimension
+        self.fast_decode = fast_decode
         self.max_file_size = max_file_size
         self.patch_sizes = patch_sizes or [8, 14, 16, 32]
         self.lcm = math.lcm(*self.patch_sizes)
+        # "budget" sizing never upscales, rounds down to the model's own patch
+        # size and caps the patch grid at token_budget (by default what a
+        # max_dimension square would cost). With adaptive, sparse images get
+        # a smaller share of the budget.
+        self.sizing = sizing
+        self.patch_size = patch_size or 14
+        self.token_budget = token_budget or (max_dimension // self.patch_size) ** 2
+        self.adaptive = adaptive
+        # measure_text records an estimate of the characters on the image in
+        # info, to size the answer's token budget
+        self.measure_text = measure_text
+        # RAW files without a usable thumbnail are demosaiced; fast_demosaic
+        # trades quality for speed and memory (half size, bilinear, 8 bit),
+        # and developed images are kept in raw_cache if one is given
+        self.fast_demosaic = fast_demosaic
+        self.raw_cache = raw_cache
+        # perceptual_hash records a difference hash of every image in info
+        # so near-duplicates can be found (see dedup.DuplicateIndex)
+        self.perceptual_hash = perceptual_hash
+        # multipage reads every page of a PDF and every frame of a TIFF or
+        # GIF as its own image; otherwise only the first one is read
+        self.multipage = multipage
+        # triage labels each resized image blank, low_text or text and marks
+        # the labels it skips in info, so no model call is made for them
+        self.triage = triage
+        # "gray" is lossless grayscale PNG and "bilevel" 1-bit PNG, both much
+        # smaller than colour JPEG for scanned text. With passthrough, JPEGs
+        # that are already the right size are sent without re-encoding.
+        self.encoding = encoding
+        self.jpeg_quality = jpeg_quality
+        self.passthrough = passthrough
         self.image_extensions = {
             "JPEG": [
                 ".jpg",
@@ -39,6 +106,7 @@ class ImageProcessor:
             "TIFF": [".tiff", ".tif"],
             "WEBP": [".webp"],
             "HEIF": [".heif", ".heic"],
+            "PDF": [".pdf"],
             "RAW": [
                 ".raw",  # Generic RAW
                 ".arw",  # Sony
@@ -58,6 +126,12 @@ class ImageProcessor:
                 ".rwl",  # Leica
             ],
         }
+    encodings = {"jpeg": "image/jpeg", "gray": "image/png", "bilevel": "image/png"}
+
+    @property
+    def mime_type(self) -> str:
+        return self.encodings[self.encoding]
+
     def _get_image_type(self, file_path):
         """ Return the image type based on extension
         """
@@ -70,9 +144,13 @@ class ImageProcessor:
                 return file_type
         return None
     
-    def _calculate_dimensions(self, width: int, height: int) -> Tuple[int, int]:
+    def _calculate_dimensions(self, width: int, height: int,
+                              density: Optional[float] = None) -> Tuple[int, int]:
         """ Calculate dimensions maintaining aspect ratio and patch compatibility 
         """
+        if self.sizing == "budget":
+            return self._budget_dimensions(width, height, density)
+            
         scale = min(self.max_dimension / width, self.max_dimension / height)
         
         scaled_width = width * scale
@@ -83,72 +161,492 @@ class ImageProcessor:
         
         return new_width, new_height
 
-    def _resize_image(self, img: Image.Image) -> Image.Image:
+    def _budget_dimensions(self, width: int, height: int,
+                           density: Optional[float] = None) -> Tuple[int, int]:
+        """ Largest patch aligned size within max_dimension and the token budget,
+            never larger than the source
+        """
+        p = self.patch_size
+        budget = self.token_budget
+        if density is not None:
+            # Text covering >= 12% edge pixels gets the full budget, blank-ish
+            # images no less than a quarter of it
+            budget = max(1, int(budget * min(1.0, max(0.25, density / 0.12))))
+        scale = min(
+            1.0,
+            self.max_dimension / max(width, height),
+            math.sqrt(budget * p * p / (width * height)),
+        )
+        new_width = max(p, math.floor(width * scale / p) * p)
+        new_height = max(p, math.floor(height * scale / p) * p)
+        while self.estimate_tokens(new_width, new_height) > budget and max(new_width, new_height) > p:
+            if new_width >= new_height:
+                new_width -= p
+            else:
+                new_height -= p
+        return new_width, new_height
+
+    def estimate_tokens(self, width: int, height: int) -> int:
+        """ Vision tokens for an image of this size, one per patch
+        """
+        return math.ceil(width / self.patch_size) * math.ceil(height / self.patch_size)
+
+    def _text_density(self, img: Image.Image) -> float:
+        """ Fraction of strong edge pixels on a small grayscale copy; text
+            heavy pages score high, photos and blank pages low
+        """
+        small = img.convert("L")
+        small.thumbnail((256, 256))
+        histogram = small.filter(ImageFilter.FIND_EDGES).histogram()
+        return sum(histogram[48:]) / max(1, small.width * small.height)
+
+    def _text_amount(self, img: Image.Image, side: int = 1600) -> int:
+        """ Rough number of characters on an image
+
+        Glyphs are counted as the Euler number (pieces of ink minus their
+        holes) of the thresholded image at up to `side` pixels, which comes
+        to about 0.65 per character of running text whatever the size of the
+        print, so small print counts as more text rather than less.
+        """
+        # Imported here so runs without --dynamic-max-tokens do not pay for NumPy
+        import numpy as np
+        small = img.convert("L")
+        small.thumbnail((side, side))
+        gray = np.asarray(small, dtype=np.int16)
+        ink = np.pad(np.abs(gray - int(np.median(gray))) > 80, 1)
+        # Count 2x2 neighbourhoods by how many of their pixels are ink
+        a, b, c, d = ink[:-1, :-1], ink[:-1, 1:], ink[1:, :-1], ink[1:, 1:]
+        inked = a.astype(np.int8) + b + c + d
+        corners = np.count_nonzero(inked == 1) - np.count_nonzero(inked == 3)
+        diagonals = np.count_nonzero((inked == 2) & (a == d))
+        return max(0, round((corners + 2 * diagonals) / 4 / 0.65))
+
+    def dhash(self, img: Image.Image, size: int = 16) -> str:
+        """ Difference hash: size x size bits, each set where a cell of a tiny
+            grayscale copy is brighter than its right neighbour; as hex
+        """
+        small = img.convert("L").resize((size + 1, size), Image.Resampling.BOX)
+        pixels = small.tobytes()
+        bits = 0
+        for row in range(size):
+            offset = row * (size + 1)
+            for col in range(size):
+                bits = bits << 1 | (pixels[offset + col] > pixels[offset + col + 1])
+        return f"{bits:0{size * size // 4}x}"
+
+    def fingerprint(self, img: Image.Image, size: int = 96) -> bytes:
+        """ size x size grayscale copy, compared pixel by pixel to confirm that
+            images with close hashes really show the same thing
+        """
+        return img.convert("L").resize((size, size), Image.Resampling.BOX).tobytes()
+
+    def _resize_image(self, img: Image.Image, info: Optional[dict] = None,
+                      triage: bool = True, size: Optional[Tuple[int, int]] = None) -> Image.Image:
         """ Resize image ensuring patch compatibility
+        
+        If info is given it is updated with the new size and token estimate,
+        and with the triage label unless triage is False (for tiles). size,
+        if given, replaces the configured sizing (tiles are cut to size).
         """
-        new_width, new_height = self._calculate_dimensions(*img.size)
+        start = time.perf_counter()
+        adaptive = self.sizing == "budget" and self.adaptive and size is None
+        density = self._text_density(img) if adaptive else None
+        if size is not None:
+            new_width, new_height = size
+        else:
+            new_width, new_height = self._calculate_dimensions(*img.size, density=density if adaptive else None)
+        if info is not None:
+            info["width"] = new_width
+            info["height"] = new_height
+            info["tokens"] = self.estimate_tokens(new_width, new_height)
+            if density is not None:
+                info["density"] = round(density, 4)
+            if self.measure_text and size is None:
+                info["characters"] = self._text_amount(img)
         if new_width != img.width or new_height != img.height:
-            return img.resize((new_width, new_height), Image.Resampling.BICUBIC)
+            img = img.resize((new_width, new_height), Image.Resampling.BICUBIC)
+        if self.perceptual_hash and info is not None:
+            info["dhash"] = self.dhash(img)
+            info["fingerprint"] = self.fingerprint(img)
+        if self.triage and triage and info is not None:
+            self._triage(img, info)
+        if info is not None:
+            info["resize_ms"] = round(1000 * (time.perf_counter() - start), 2)
+        return img
+
+    def _triage(self, img: Image.Image, info: dict):
+        start = time.perf_counter()
+        label, stats = self.triage.classify(img)
+        info["triage"] = label
+        info["triage_ms"] = round(1000 * (time.perf_counter() - start), 2)
+        if label in self.triage.skip:
+            info["skipped"] = (
+                f"{label} (contrast {stats['contrast']}, ink {stats['ink']}, "
+                f"edges {stats['edges']}, {stats['text_cells']} text cells)"
+            )
+
+    def _load_rgb(self, img: Image.Image, info: Optional[dict] = None) -> Image.Image:
+        """ Decode the pixel data now, so its time is recorded as decode_ms
+        """
+        start = time.perf_counter()
+        img.load()
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        if info is not None:
+            info["decode_ms"] = round(1000 * (time.perf_counter() - start), 2)
+        return img
+
+    def _encode(self, img: Image.Image, info: Optional[dict] = None) -> str:
+        """ Encode a resized image for the request in the configured format
+        """
+        start = time.perf_counter()
+        buffer = io.BytesIO()
+        if self.encoding == "gray":
+            img.convert("L").save(buffer, format="PNG")
+        elif self.encoding == "bilevel":
+            img.convert("L").convert("1", dither=Image.Dither.NONE).save(buffer, format="PNG")
+        else:
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.save(buffer, format="JPEG", quality=self.jpeg_quality)
+        data = buffer.getvalue()
+        if info is not None:
+            info["encode_ms"] = round(1000 * (time.perf_counter() - start), 2)
+            info["payload_bytes"] = len(data)
+        return base64.b64encode(data).decode()
+
+    def _passthrough_bytes(self, img: Image.Image, data: Union[str, Path, bytes],
+                           info: Optional[dict] = None) -> Optional[str]:
+        """ Return the source JPEG unchanged if resizing would not alter it
+        
+        img must be freshly opened and not yet decoded or drafted.
+        """
+        if not self.passthrough or self.encoding != "jpeg":
+            return None
+        if self.adaptive or self.measure_text or self.triage:
+            # These need the decoded pixels
+            return None
+        if img.format != "JPEG" or img.mode not in ("RGB", "L"):
+            return None
+        new_width, new_height = self._calculate_dimensions(*img.size)
+        # Only allow the difference patch rounding would make, never a rescale
+        unit = self.patch_size if self.sizing == "budget" else self.lcm
+        if abs(new_width - img.width) >= unit or abs(new_height - img.height) >= unit:
+            return None
+        if not isinstance(data, bytes):
+            with open(data, "rb") as f:
+                data = f.read()
+        if info is not None:
+            info["width"], info["height"] = img.size
+            info["tokens"] = self.estimate_tokens(*img.size)
+            info["encode_ms"] = 0.0
+            info["payload_bytes"] = len(data)
+            info["passthrough"] = 1
+            if self.perceptual_hash:
+                # Decoding at 1/8 scale in the DCT domain is plenty for the hash
+                img.draft("L", (img.width // 8, img.height // 8))
+                info["dhash"] = self.dhash(img)
+                info["fingerprint"] = self.fingerprint(img)
+        return base64.b64encode(data).decode()
+
+    def _open_image(self, file: Union[str, Path, io.BytesIO]) -> Image.Image:
+        """ Open an image, asking the decoder for a reduced resolution when
+            the full one would only be thrown away by the resize
+        """
+        img = Image.open(file)
+        if not self.fast_decode:
+            return img
+        target = self._calculate_dimensions(*img.size)
+        if img.format == "JPEG2000":
+            # Skip wavelet resolution levels; most encoders write at least 4
+            factor = min(img.width / target[0], img.height / target[1])
+            if factor >= 2:
+                img.reduce = min(int(math.log2(factor)), 3)
+                # The reduced size only takes effect once the tiles are decoded
+                img.load()
+        else:
+            # JPEG scales in the DCT domain, HEIF picks an embedded thumbnail
+            # that is at least the target size, other formats ignore this
+            img.draft("RGB", target)
         return img
 
-    def process_raw_image(self, file_path: Union[str, Path]) -> str:
+    # File types whose pages or frames are read as separate images
+    multipage_types = ("PDF", "TIFF", "GIF")
+
+    def page_count(self, file_path: Union[str, Path]) -> int:
+        """ Number of pages (PDF) or frames (TIFF, GIF) to read from a file,
+            1 for other images or when multipage is off
+        """
+        image_type = self._get_image_type(file_path)
+        if not self.multipage or image_type not in self.multipage_types:
+            return 1
+        if image_type == "PDF":
+            with _pdf_lock:
+                pdf = self._open_pdf(file_path)
+                try:
+                    return len(pdf)
+                finally:
+                    pdf.close()
+        with Image.open(file_path) as img:
+            return getattr(img, "n_frames", 1)
+
+    def _open_pdf(self, file_path: Union[str, Path]):
+        try:
+            import pypdfium2
+        except ImportError:
+            # Optional: only needed to read PDFs
+            raise ValueError("Reading PDFs needs pypdfium2 (pip install pypdfium2)")
+        try:
+            return pypdfium2.PdfDocument(str(file_path))
+        except pypdfium2.PdfiumError as e:
+            raise ValueError(f"Could not open PDF: {e}")
+
+    def _render_pdf_page(self, file_path: Union[str, Path], page: int, dimension: int,
+                         info: Optional[dict] = None) -> Image.Image:
+        """ Rasterize one PDF page so its longest side is `dimension` pixels
+
+        Only this page is rendered, so memory does not depend on the length
+        of the document.
+        """
+        start = time.perf_counter()
+        with _pdf_lock:
+            pdf = self._open_pdf(file_path)
+            try:
+                pdf_page = pdf[page]
+                width, height = pdf_page.get_size()
+                bitmap = pdf_page.render(scale=dimension / max(width, height, 1))
+                # Copy the pixels out of PDFium's buffer before the document is closed
+                img = bitmap.to_pil().convert("RGB")
+            finally:
+                pdf.close()
+        if info is not None:
+            info["decode_ms"] = round(1000 * (time.perf_counter() - start), 2)
+        return img
+
+    # Peak bytes of memory per byte of RAW file while demosaicing: the
+    # unpacked sensor data, LibRaw's 4 x 16 bit working image and the output
+    raw_memory_factor = {"quality": 10, "fast": 4}
+
+    @property
+    def demosaic_mode(self) -> str:
+        return "fast" if self.fast_demosaic else "quality"
+
+    def raw_memory_estimate(self, file_path: Union[str, Path]) -> int:
+        """ Rough peak memory of developing a RAW file in bytes, 0 for other files
+        """
+        if self._get_image_type(file_path) != "RAW":
+            return 0
+        return os.path.getsize(file_path) * self.raw_memory_factor[self.demosaic_mode]
+
+    def _raw_dimension(self) -> int:
+        """ Longest side a developed RAW image needs for the configured sizing
+        """
+        if self.sizing == "budget":
+            # Enough for the token budget at aspect ratios up to 4:1
+            return int(2 * self.patch_size * math.sqrt(self.token_budget))
+        return self.max_dimension
+
+    def _develop_raw(self, file_path: Union[str, Path], dimension: int, info: Optional[dict] = None,
+                     raw=None) -> Image.Image:
+        """ Demosaic a RAW file to at least `dimension` on its longest side,
+            reusing an earlier development from raw_cache when there is one
+        """
+        key = None
+        if self.raw_cache:
+            key = self.raw_cache.key(file_path, self.demosaic_mode)
+            img = self.raw_cache.get(key, dimension)
+            if img is not None:
+                if info is not None:
+                    info["raw_reused"] = 1
+                return img
+        start = time.perf_counter()
+        if raw is None:
+            import rawpy
+            with rawpy.imread(str(file_path)) as raw:
+                img = self._demosaic(raw, dimension)
+        else:
+            img = self._demosaic(raw, dimension)
+        if info is not None:
+            info["raw_developed"] = 1
+            info["demosaic_ms"] = round(1000 * (time.perf_counter() - start), 2)
+        if self.raw_cache:
+            self.raw_cache.put(key, img)
+        return img
+
+    def _demosaic(self, raw, dimension: int) -> Image.Image:
+        import rawpy
+        if self.fast_demosaic:
+            rgb = raw.postprocess(
+                half_size=True, demosaic_algorithm=rawpy.DemosaicAlgorithm.LINEAR,
+                use_camera_wb=True, output_bps=8
+            )
+        else:
+            # Half size demosaic skips interpolation and is 4x smaller; only
+            # use it when the result is still at least as big as the target
+            half_size = self.fast_decode and max(raw.sizes.width, raw.sizes.height) >= 2 * dimension
+            rgb = raw.postprocess(half_size=half_size)
+        return Image.fromarray(rgb)
+
+    def process_raw_image(self, file_path: Union[str, Path], info: Optional[dict] = None) -> str:
         """ Process RAW image files
         """
+        if self.raw_cache:
+            # A cached development means there was no usable thumbnail
+            cached = self.raw_cache.get(self.raw_cache.key(file_path, self.demosaic_mode), self._raw_dimension())
+            if cached is not None:
+                if info is not None:
+                    info["raw_reused"] = 1
+                return self._encode(self._resize_image(cached, info), info)
+        import rawpy
         with rawpy.imread(str(file_path)) as raw:
             try:
                 # Try to extract embedded JPEG thumbnail first
                 thumb = raw.extract_thumb()
                 if thumb.format == rawpy.ThumbFormat.JPEG:
-                    thumb_img = Image.open(io.BytesIO(thumb.data))
-                    resized = self._resize_image(thumb_img)
-                    buffer = io.BytesIO()
-                    resized.save(buffer, format="JPEG", quality=95)
-                    return base64.b64encode(buffer.getvalue()).decode()
+                    with Image.open(io.BytesIO(thumb.data)) as header:
+                        encoded = self._passthrough_bytes(header, thumb.data, info)
+                    if encoded:
+                        return encoded
+                    thumb_img = self._load_rgb(self._open_image(io.BytesIO(thumb.data)), info)
+                    resized = self._resize_image(thumb_img, info)
+                    return self._encode(resized, info)
             except:
                 pass
 
-            rgb = raw.postprocess()
-            img = Image.fromarray(rgb)
-            resized = self._resize_image(img)
-            buffer = io.BytesIO()
-            resized.save(buffer, format="JPEG", quality=95)
-            return base64.b64encode(buffer.getvalue()).decode()
+            target = self._calculate_dimensions(raw.sizes.width, raw.sizes.height)
+            img = self._develop_raw(file_path, max(target), info, raw)
+            resized = self._resize_image(img, info)
+            return self._encode(resized, info)
             
-    def route_image(self, file_path: Union[str, Path]) -> Optional[str]:
-        """ Process image """
-        if os.path.getsize(file_path) > self.max_file_size:
+    def _tile_positions(self, length: int, tile: int, overlap: int) -> List[int]:
+        """ Evenly spaced tile offsets covering length with at least overlap px shared
+        """
+        if length <= tile:
+            return [0]
+        count = math.ceil((length - overlap) / (tile - overlap))
+        return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+    def tile_image(self, file_path: Union[str, Path], tile_size: Optional[int] = None,
+                   overlap: float = 0.15, page_dimension: Optional[int] = None,
+                   info: Optional[dict] = None, page: Optional[int] = None) -> List[str]:
+        """ Split a page into overlapping full-width bands, top to bottom, and
+            encode each one
+        
+        The page is first scaled so its longest side is at most page_dimension
+        (3 tiles by default), then cut into bands as wide as the page holding
+        about as many pixels as a tile_size square, each sharing `overlap` of
+        its height with the next. Bands keep every text line whole, so their
+        transcriptions read in order and the overlap is removed line by line
+        (see llmocr.merge_tile_texts); a grid of tiles would split each line
+        into pieces. Bands are sent at the size they are cut, so a page is
+        read at page_dimension whatever the sizing. page picks a page of a
+        PDF or a frame of a TIFF or GIF.
+        """
+        tile_size = tile_size or self.max_dimension
+        page_dimension = page_dimension or 3 * tile_size
+        if not 0 <= overlap < 0.5:
+            raise ValueError("overlap must be between 0 and 0.5")
+        image_type = self._get_image_type(file_path)
+        if os.path.getsize(file_path) > self.max_file_size and image_type != "PDF":
             raise ValueError(f"File exceeds size limit of {self.max_file_size} bytes")
-            
+        if image_type is None:
+            return []
+        if image_type == "HEIF":
+            _register_heif()
+        start = time.perf_counter()
+        try:
+            if image_type == "RAW":
+                img = self._develop_raw(file_path, page_dimension, info)
+            elif image_type == "PDF":
+                img = self._render_pdf_page(file_path, page or 0, page_dimension)
+            else:
+                img = Image.open(file_path)
+                if page:
+                    img.seek(page)
+                if self.fast_decode:
+                    img.draft("RGB", (page_dimension, page_dimension))
+                img = img.convert("RGB")
+        except (IOError, OSError) as e:
+            raise ValueError(f"Image processing failed: {str(e)}")
+        if info is not None:
+            info["decode_ms"] = round(1000 * (time.perf_counter() - start), 2)
+        scale = min(1.0, page_dimension / max(img.size))
+        if scale < 1.0:
+            img = img.resize(
+                (round(img.width * scale), round(img.height * scale)), Image.Resampling.BICUBIC
+            )
+        unit = self.lcm
+        width = max(unit, round(img.width / unit) * unit)
+        # The height that gives a band the pixels of a tile, in whole patches
+        band = min(tile_size, max(unit, round(tile_size * tile_size / width / unit) * unit))
+        tiles = []
+        for top in self._tile_positions(img.height, band, int(band * overlap)):
+            tile_info = {}
+            crop = img.crop((0, top, img.width, min(top + band, img.height)))
+            size = (width, max(unit, math.ceil(crop.height / unit) * unit))
+            tiles.append(self._encode(self._resize_image(crop, tile_info, triage=False, size=size), tile_info))
+            if info is not None:
+                for key in ("tokens", "resize_ms", "encode_ms", "payload_bytes"):
+                    info[key] = info.get(key, 0) + tile_info.get(key, 0)
+        if info is not None:
+            info["tiles"] = len(tiles)
+            if not page:
+                info["source_bytes"] = os.path.getsize(file_path)
+        return tiles
+
+    def route_image(self, file_path: Union[str, Path], info: Optional[dict] = None,
+                    page: Optional[int] = None) -> Optional[str]:
+        """ Process image, or one page (PDF) or frame (TIFF, GIF) of it """
+        file_size = os.path.getsize(file_path)
         image_type = self._get_image_type(file_path)
+        # PDF pages are rendered one at a time, so long documents are fine
+        if file_size > self.max_file_size and image_type != "PDF":
+            raise ValueError(f"File exceeds size limit of {self.max_file_size} bytes")
+        if info is not None and not page:
+            # Counted once per file, with its first page
+            info["source_bytes"] = file_size
+            
         if image_type is None:
             return None
+        if image_type == "HEIF":
+            _register_heif()
             
         try:
             if image_type == "RAW":
-                return self.process_raw_image(file_path)
+                return self.process_raw_image(file_path, info)
+                
+            if image_type == "PDF":
+                # Twice the target, so the resize rather than the rasterizer
+                # sets the final size
+                img = self._render_pdf_page(file_path, page or 0, 2 * self.max_dimension, info)
+                return self._encode(self._resize_image(img, info), info)
                 
-            with Image.open(file_path) as img:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
+            if not page:
+                with Image.open(file_path) as header:
+                    encoded = self._passthrough_bytes(header, file_path, info)
+                if encoded:
+                    return encoded
+                
+            with self._open_image(file_path) as img:
+                if page:
+                    img.seek(page)
+                img = self._load_rgb(img, info)
                     
                 if img.width <= 0 or img.height <= 0:
                     raise ValueError("Invalid image dimensions")
                     
-                resized = self._resize_image(img)
-                
-                with io.BytesIO() as buffer:
-                    resized.save(buffer, format="JPEG", quality=95)
-                    return base64.b64encode(buffer.getvalue()).decode()
+                resized = self._resize_image(img, info)
+                return self._encode(resized, info)
                     
         except (IOError, OSError) as e:
             raise ValueError(f"Image processing failed: {str(e)}")
             
         return None
         
-    def process_image(self, image_path):    
+    def process_image(self, image_path, info: Optional[dict] = None, page: Optional[int] = None):    
         """ Process an image through the LLM
         """
-        encoded = self.route_image(image_path)
+        encoded = self.route_image(image_path, info, page)
         
         if not encoded:
             return None, Path(image_path)
@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+import time
+from typing import Iterable, Iterator, Optional
+
+
+class Journal:
+    """ Append-only JSON lines record of each file's progress through a batch
+
+    Every file is logged as pending when it is queued and as done or failed
+    when its result is written, with its mtime, size and how long it took,
+    and why it was skipped if triage skipped it.
+    The last entry for a path wins, so a resumed run can skip finished files
+    from the journal alone instead of checking for output files.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A run killed mid-write leaves a truncated last line
+                        continue
+                    self.entries[entry["path"]] = entry
+        self._file = open(path, "a", encoding="utf-8")
+
+    def status(self, file_path) -> Optional[str]:
+        entry = self.entries.get(str(file_path))
+        return entry["status"] if entry else None
+
+    def remaining(self, file_list: Iterable) -> Iterator:
+        """ Yield the files that are not recorded as done
+        """
+        for file_path in file_list:
+            if self.status(file_path) != "done":
+                yield file_path
+
+    def record(self, file_path, status: str, duration: float = 0.0, error: Optional[str] = None,
+               skipped: Optional[str] = None):
+        entry = {"path": str(file_path), "status": status, "time": time.time()}
+        if status != "pending":
+            try:
+                stat = os.stat(file_path)
+                entry["mtime"] = stat.st_mtime
+                entry["size"] = stat.st_size
+            except OSError:
+                pass
+            entry["duration"] = round(duration, 3)
+        if error:
+            entry["error"] = error
+        if skipped:
+            entry["skipped"] = skipped
+        with self._lock:
+            self.entries[entry["path"]] = entry
+            self._file.write(json.dumps(entry) + "\n")
+            if status != "pending":
+                self._file.flush()
+
+    def counts(self) -> dict:
+        counts = {}
+        with self._lock:
+            for entry in self.entries.values():
+                counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def report(self) -> str:
+        counts = self.counts()
+        return (
+            f" journal: {counts.get('done', 0)} done, {counts.get('failed', 0)} failed, "
+            f"{counts.get('pending', 0)} pending"
+        )
@@ -5,11 +5,13 @@ import time
 from typing import Optional, List
 
 from PyQt6.QtWidgets import (
-    QApplication, QMainWindow, QWidget, QVBoxLayout, QPushButton, 
-    QLineEdit, QLabel, QFileDialog, QProgressBar, QTextEdit, QComboBox
+    QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, 
+    QLineEdit, QLabel, QFileDialog, QProgressBar, QTextEdit, QComboBox, QSpinBox,
+    QTableWidget, QTableWidgetItem, QHeaderView
 )
 from PyQt6.QtCore import Qt, QThread, pyqtSignal
 from llmocr import LLMProcessor
+from pipeline import Pipeline
 
 class ClipboardHandler:
     """Copies to clipboard across all platforms"""
@@ -27,27 +29,62 @@ class ClipboardHandler:
             return False
 
 class ProcessingThread(QThread):
-    progress = pyqtSignal(int, int)  # current, total
+    progress = pyqtSignal(int, int)  # completed, total
     finished = pyqtSignal()
     error = pyqtSignal(str)
+    cancelled = pyqtSignal(int, int)  # completed, total
     result_ready = pyqtSignal(str)  # Clipboard signal
+    token = pyqtSignal(int, str)  # file index, streamed text as it is generated
+    file_done = pyqtSignal(int, str, str)  # file index, status, result or error
     
-    def __init__(self, processor: LLMProcessor, files: List[str]):
+    def __init__(self, processor: LLMProcessor, files: List[str], workers: int = 1):
         super().__init__()
         self.processor = processor
         self.files = files
+        # Decode on threads: forking worker processes from a running Qt app
+        # is not safe on every platform
+        self.pipeline = Pipeline(processor, workers, decode_workers=0, raw_workers=0)
+        self.completed = 0
+        self.failed = 0
+        self.stopping = False
+        
+    def cancel(self):
+        """Stop the batch now, aborting the requests in flight"""
+        self.stopping = True
+        self.pipeline.stop(cancel=True)
+        
+    def on_token(self, item, text):
+        self.token.emit(item.file_index, text)
+        
+    def on_result(self, item):
+        # Called in file order, after the caption has been saved
+        self.completed += 1
+        if item.error:
+            self.failed += 1
+            self.file_done.emit(item.file_index, "failed", str(item.error))
+        else:
+            self.file_done.emit(item.file_index, self.pipeline.status(item), item.result or "")
+            if item.result:
+                self.result_ready.emit(item.result)
+        self.progress.emit(self.completed, len(self.files))
         
     def run(self):
         try:
-            for i, file_path in enumerate(self.files):
-                result, output_path = self.processor.process_file(file_path)
-                if result:
-                    self.processor.save_result(result, output_path)
-                    self.result_ready.emit(result)
-                self.progress.emit(i + 1, len(self.files))
-            self.finished.emit()
+            self.pipeline.run(self.files, self.on_result, self.on_token)
         except Exception as e:
             self.error.emit(str(e))
+            return
+        if self.stopping:
+            self.cancelled.emit(self.completed, len(self.files))
+        elif self.failed:
+            self.error.emit(f"{self.failed} of {len(self.files)} files failed")
+        else:
+            self.finished.emit()
+
+def format_eta(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
 
 class MainWindow(QMainWindow):
     
@@ -96,18 +133,46 @@ class MainWindow(QMainWindow):
         self.files_label = QLabel("No files selected")
         layout.addWidget(self.files_label)
         
+        workers_layout = QHBoxLayout()
+        workers_layout.addWidget(QLabel("Workers:"))
+        self.workers = QSpinBox()
+        self.workers.setRange(1, 64)
+        self.workers.setToolTip("Requests in flight at once; up to the server's multiuser slots")
+        workers_layout.addWidget(self.workers)
+        workers_layout.addStretch()
+        layout.addLayout(workers_layout)
+        
         self.progress = QProgressBar()
         layout.addWidget(self.progress)
+        self.eta_label = QLabel("")
+        layout.addWidget(self.eta_label)
         
+        buttons_layout = QHBoxLayout()
         self.process_button = QPushButton("Process Images")
         self.process_button.clicked.connect(self.process_files)
         self.process_button.setEnabled(False)
-        layout.addWidget(self.process_button)
+        buttons_layout.addWidget(self.process_button)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_processing)
+        self.cancel_button.setEnabled(False)
+        buttons_layout.addWidget(self.cancel_button)
+        layout.addLayout(buttons_layout)
+        
+        self.results = QTableWidget(0, 3)
+        self.results.setHorizontalHeaderLabels(["File", "Status", "Caption"])
+        self.results.horizontalHeader().setSectionResizeMode(2, QHeaderView.ResizeMode.Stretch)
+        self.results.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.results.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
+        self.results.currentCellChanged.connect(self.show_selected)
+        layout.addWidget(self.results)
         
         self.result_label = QLabel("")
+        self.result_label.setWordWrap(True)
         layout.addWidget(self.result_label)
         
         self.selected_files = []
+        self.texts = []
+        self.finished_rows = set()
         
     def select_files(self):
         files, _ = QFileDialog.getOpenFileNames(
@@ -127,20 +192,62 @@ class MainWindow(QMainWindow):
             
         self.process_button.setEnabled(False)
         self.file_button.setEnabled(False)
+        self.workers.setEnabled(False)
+        self.cancel_button.setEnabled(True)
         
         processor = LLMProcessor(
             self.api_url.text(),
             self.system_instruction,
-            self.instruction.text()
+            self.instruction.text(),
+            self.workers.value()
         )
+        processor.stream = True
+        
+        self.texts = [""] * len(self.selected_files)
+        self.finished_rows = set()
+        self.results.setRowCount(len(self.selected_files))
+        for row, file_path in enumerate(self.selected_files):
+            self.results.setItem(row, 0, QTableWidgetItem(os.path.basename(file_path)))
+            self.results.setItem(row, 1, QTableWidgetItem("queued"))
+            self.results.setItem(row, 2, QTableWidgetItem(""))
+        self.result_label.setText("")
+        self.eta_label.setText("")
+        self.started = time.monotonic()
         
-        self.thread = ProcessingThread(processor, self.selected_files)
+        self.thread = ProcessingThread(processor, self.selected_files, self.workers.value())
+        self.thread.token.connect(self.show_token)
+        self.thread.file_done.connect(self.show_result)
         self.thread.progress.connect(self.update_progress)
         self.thread.finished.connect(self.processing_finished)
         self.thread.error.connect(self.processing_error)
+        self.thread.cancelled.connect(self.processing_cancelled)
         self.thread.result_ready.connect(self.handle_result)
         self.thread.start()
     
+    def cancel_processing(self):
+        self.cancel_button.setEnabled(False)
+        self.files_label.setText("Cancelling...")
+        self.thread.cancel()
+    
+    def set_row(self, row, status, text):
+        self.results.item(row, 1).setText(status)
+        self.results.item(row, 2).setText(text[-200:].replace("\n", " "))
+    
+    def show_token(self, row, text):
+        """Show the caption as it is generated"""
+        self.texts[row] += text
+        self.set_row(row, "working", self.texts[row])
+        self.result_label.setText(self.texts[row][-300:])
+    
+    def show_result(self, row, status, text):
+        self.texts[row] = text
+        self.finished_rows.add(row)
+        self.set_row(row, status, text)
+    
+    def show_selected(self, row, column, previous_row, previous_column):
+        if 0 <= row < len(self.texts):
+            self.result_label.setText(self.texts[row][-300:])
+    
     def handle_result(self, result: str):
         """Handle new result by copying to clipboard and updating UI"""
         if self.clipboard_handler.copy_text(result):
@@ -150,19 +257,31 @@ class MainWindow(QMainWindow):
     
     def update_progress(self, current, total):
         self.progress.setValue(int((current / total) * 100))
+        # Throughput so far, so the estimate follows the number of workers
+        elapsed = time.monotonic() - self.started
+        rate = current / elapsed if elapsed > 0 else 0
+        eta = format_eta((total - current) / rate) if rate else "-"
+        self.eta_label.setText(f"{current} of {total} files, {rate:.2f} files/s, ETA {eta}")
     
-    def processing_finished(self):
+    def processing_done(self, message):
         self.process_button.setEnabled(True)
         self.file_button.setEnabled(True)
-        self.files_label.setText("Processing completed")
+        self.workers.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        self.files_label.setText(message)
         self.progress.setValue(0)
     
+    def processing_finished(self):
+        self.processing_done("Processing completed")
+    
     def processing_error(self, error_msg):
-        self.process_button.setEnabled(True)
-        self.file_button.setEnabled(True)
-        self.files_label.setText(f"Error: {error_msg}")
-        self.progress.setValue(0)
-        self.result_label.setText("")
+        self.processing_done(f"Error: {error_msg}")
+    
+    def processing_cancelled(self, completed, total):
+        for row in range(total):
+            if row not in self.finished_rows:
+                self.set_row(row, "cancelled", self.texts[row])
+        self.processing_done(f"Cancelled after {completed} of {total} files")
 
 def main():
     app = QApplication(sys.argv)
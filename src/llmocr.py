@@ -1,14 +1,31 @@
 import sys
 import os
 import io
-import requests
 import argparse
+import difflib
+import re
+import socket
+import threading
+import time
 
-from typing import Optional, List
+from typing import Optional, List, Tuple
+from api_client import ApiClient
+from dedup import DuplicateIndex
+from file_source import iter_files
+from generation import RepetitionDetector, previous_result, token_budget, tokens_saved
 from image_processor import ImageProcessor
+from journal import Journal
+from load_balancer import Endpoint, LoadBalancer
+from metrics import JsonLinesHook, Metrics
+from pipeline import Pipeline, bounded_map
+from raw_cache import RawCache
+from result_cache import ResultCache
+from result_writer import JsonLinesOutput, write_atomic
+from triage import Triage
 
 class LLMProcessor:
-    def __init__(self, api_url, api_password, instruction):
+    def __init__(self, api_url, api_password, instruction, concurrency=1,
+                 connect_timeout=10.0, read_timeout=300.0, retries=3, endpoints=None):
         self.instruction = instruction
         self.max_length = 2048
         self.top_p = 1
@@ -20,18 +37,170 @@ class LLMProcessor:
         self.api_password = api_password
         self.image_processor = ImageProcessor(max_dimension=896)
         self.system_instruction = "You are a helpful image capable model"
+        if endpoints:
+            # Several servers: requests go to the least loaded healthy one
+            self.client = LoadBalancer(endpoints, concurrency, connect_timeout, read_timeout, retries)
+        else:
+            self.client = ApiClient(
+                api_url, api_password, pool_size=concurrency,
+                connect_timeout=connect_timeout, read_timeout=read_timeout, retries=retries
+            )
+        self.cache = None
+        # Optional metrics.Metrics receiving a record per processed file
+        self.metrics = None
+        # Optional result_writer.JsonLinesOutput used instead of .txt sidecars
+        self.output = None
+        self._model = None
+        # Tiling: tile_size of None sends each page as one image
+        self.tile_size = None
+        self.tile_overlap = 0.15
+        self.tile_parallel = 4
+        self.page_dimension = None
+        # Stream tokens (SSE) instead of waiting for the whole answer
+        self.stream = False
+        # Generation control: dynamic_max_tokens sizes each answer's budget
+        # from the amount of text on the image or an earlier transcription,
+        # early_stop aborts streams that start repeating themselves
+        self.dynamic_max_tokens = False
+        self.min_tokens = 128
+        self.early_stop = False
+        self.stop_sequences = []
+        # Images packed into one request by the pipeline (1 sends each alone)
+        self.batch_size = 1
+        # Set by cancel(); no new requests are sent while it is set
+        self.abort = threading.Event()
+        
+    def cancel(self):
+        """Abort every request in flight, including ones the model has not answered yet"""
+        self.abort.set()
+        self.client.abort()
+
+    def model_id(self) -> str:
+        """Name of the model the API is serving, looked up until a lookup
+        succeeds ("" while the server cannot say)"""
+        if self._model is None:
+            try:
+                models = self.client.get("/v1/models").get("data", [])
+            except Exception:
+                return ""
+            self._model = models[0].get("id", "") if models else ""
+        return self._model
+        
+    def settings(self) -> dict:
+        """Everything besides the image that changes the model's answer"""
+        settings = {
+            "instruction": self.instruction,
+            "system_instruction": self.system_instruction,
+            "max_tokens": self.max_length,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "top_k": self.top_k,
+            "rep_pen": self.rep_pen,
+            "min_p": self.min_p,
+            "max_dimension": self.image_processor.max_dimension,
+            "sizing": self.image_processor.sizing,
+            "encoding": self.image_processor.encoding,
+            "jpeg_quality": self.image_processor.jpeg_quality,
+            "model": self.model_id(),
+        }
+        if self.tile_size:
+            settings["tiles"] = [self.tile_size, self.tile_overlap, self.page_dimension]
+        if self.image_processor.sizing == "budget":
+            settings["patch_size"] = self.image_processor.patch_size
+            settings["token_budget"] = self.image_processor.token_budget
+            settings["adaptive"] = self.image_processor.adaptive
+        if self.batch_size > 1:
+            settings["batch_size"] = self.batch_size
+        if self.dynamic_max_tokens:
+            settings["min_tokens"] = self.min_tokens
+        if self.early_stop:
+            settings["early_stop"] = True
+        if self.stop_sequences:
+            settings["stop"] = list(self.stop_sequences)
+        if not self.image_processor.multipage:
+            settings["multipage"] = False
+        return settings
+        
+    def cache_key(self, file_path) -> str:
+        return ResultCache.make_key(str(file_path), self.settings())
+        
+    def process_file(self, file_path, on_token=None):
+        """Transcribe and save one file, returning (result, output path)
+        
+        Runs the file through a Pipeline of its own, so every page, tile,
+        triage and cache decision is the same as in a batch. Errors are raised.
+        """
+        items = []
+        pipeline = Pipeline(self, decode_workers=0, raw_workers=0)
+        pipeline.run(
+            [file_path], on_result=items.append,
+            on_token=(lambda item, text: on_token(text)) if on_token else None
+        )
+        if not items:
+            raise RuntimeError("cancelled")
+        if items[0].error:
+            raise items[0].error
+        return items[0].result, items[0].output_path
+        
+    def max_tokens_for(self, info: Optional[dict], output_path=None) -> Optional[int]:
+        """Answer budget for one image, None for the fixed max_length"""
+        if not self.dynamic_max_tokens:
+            return None
+        previous = previous_result(output_path) if output_path else None
+        return token_budget(self.max_length, info, previous, self.min_tokens)
         
-    def process_file(self, file_path):
-        """Send frames to API for analysis"""
-        image, output_path = self.image_processor.process_image(str(file_path))
+    def query(self, image: Optional[str], timings: Optional[dict] = None,
+              on_token=None, max_tokens: Optional[int] = None) -> Optional[str]:
+        """Send an encoded image to the API and return the model's text
+        
+        If timings is given it is updated with the request's connect/ttfb/total
+        seconds, completion_tokens, ttft/generation when streaming and
+        tokens_saved when a stream was closed early and budget_retries when
+        max_tokens was too small and the answer was asked for again with
+        max_length. When streaming (self.stream, self.early_stop or on_token
+        given) each piece of text is passed to on_token as it arrives.
+        max_tokens overrides max_length.
+        """
         user_content = [{"type": "text", "text": self.instruction}]    
         if image:
             user_content.append({
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/jpeg;base64,{image}"
+                    "url": f"data:{self.image_processor.mime_type};base64,{image}"
                 }
             })    
+        return self._complete(user_content, timings, on_token, max_tokens)
+        
+    def query_batch(self, images: List[str], timings: Optional[dict] = None,
+                    max_tokens: Optional[int] = None) -> Optional[List[str]]:
+        """Send several encoded images in one request, one answer per image
+        
+        The model is asked to head each answer with a marker line. Returns the
+        answers in image order, or None when the reply cannot be split into
+        exactly one answer per image and the images should be sent singly.
+        """
+        user_content = [{"type": "text", "text": (
+            f"{self.instruction}\n\nThere are {len(images)} images. Answer for each image "
+            f"separately and in order. Start each answer with a line containing only "
+            f"### Image <number>, then the answer for that image."
+        )}]
+        for number, image in enumerate(images, 1):
+            user_content.append({"type": "text", "text": f"Image {number}:"})
+            user_content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{self.image_processor.mime_type};base64,{image}"
+                }
+            })
+        text = self._complete(
+            user_content, timings, None, max_tokens or self.max_length * len(images), self.max_length * len(images)
+        )
+        return split_batch_answer(text or "", len(images))
+        
+    def _complete(self, user_content: list, timings: Optional[dict] = None, on_token=None,
+                  max_tokens: Optional[int] = None, full_tokens: Optional[int] = None) -> Optional[str]:
+        """Ask for an answer, again with full_tokens (max_length) if a smaller
+        max_tokens cut it short"""
         try:
             messages = [
                 {"role": "system", "content": self.system_instruction},
@@ -43,87 +212,598 @@ class LLMProcessor:
             
             payload = {
                 "messages": messages,
-                "max_tokens": self.max_length,
+                "max_tokens": max_tokens or self.max_length,
                 "temperature": self.temperature,
                 "top_p": self.top_p,
                 "top_k": self.top_k,
                 "rep_pen": self.rep_pen,
                 "min_p": self.min_p
             }
+            if self.stop_sequences:
+                payload["stop"] = list(self.stop_sequences)
+            if self.abort.is_set():
+                raise RuntimeError("cancelled")
             
-            endpoint = f"{self.api_url}/v1/chat/completions"
-            
-            headers = {
-                "Content-Type": "application/json"
-            }
-            
-            if self.api_password:
-                headers["Authorization"] = f"Bearer {self.api_password}"
-            
-            response = requests.post(
-                endpoint,
-                json=payload,
-                headers=headers
-            )
-            
-            response.raise_for_status()
-            response_json = response.json()
-            
-            if "choices" in response_json and len(response_json["choices"]) > 0:
-                
-                if "message" in response_json["choices"][0]:
-                    
-                    return response_json["choices"][0]["message"]["content"], output_path
-                
-                else:
-                    
-                    return response_json["choices"][0].get("text", ""), output_path
-            
-            return None
+            text, finish_reason = self._request(payload, timings, on_token)
+            full_tokens = full_tokens or self.max_length
+            if finish_reason == "length" and payload["max_tokens"] < full_tokens and not self.abort.is_set():
+                # The estimated budget was too small; a truncated transcript
+                # is worse than the tokens spent asking again
+                payload["max_tokens"] = full_tokens
+                text, _ = self._request(payload, timings, _after(on_token, len(text or "")))
+                if timings is not None:
+                    timings["budget_retries"] = 1
+            return text
             
         except Exception as e:
             raise Exception(f"Error in API call: {str(e)}")        
         
-    def save_result(self, result: str, output_path: str) -> bool:
-        """Save the processing result to a file"""
+    def _request(self, payload: dict, timings: Optional[dict] = None, on_token=None) -> Tuple[Optional[str], Optional[str]]:
+        """One completion request, returning (text, finish_reason)"""
+        if self.stream or self.early_stop or on_token:
+            return self._stream_completion(payload, timings, on_token)
+        
+        response_json, request_timings = self.client.post("/v1/chat/completions", payload)
+        if timings is not None:
+            timings.update(request_timings)
+            usage = response_json.get("usage") or {}
+            if "completion_tokens" in usage:
+                timings["completion_tokens"] = usage["completion_tokens"]
+        
+        if "choices" in response_json and len(response_json["choices"]) > 0:
+            choice = response_json["choices"][0]
+            if "message" in choice:
+                return choice["message"]["content"], choice.get("finish_reason")
+            return choice.get("text", ""), choice.get("finish_reason")
+        
+        return None, None
+        
+
+    def _stream_completion(self, payload: dict, timings: Optional[dict] = None,
+                           on_token=None) -> Tuple[str, Optional[str]]:
+        """Collect a streamed completion, passing each piece of text to on_token,
+        and return (text, finish_reason)
+        
+        With early_stop the stream is closed as soon as the text starts
+        looping, which drops the connection and frees the server's slot, and
+        the repeats are trimmed. Stop sequences are also enforced here for
+        servers that ignore them.
+        """
+        start = time.perf_counter()
+        stream_timings = {}
+        first = None
+        tokens = 0
+        text = ""
+        finish_reason = None
+        stopped = None
+        detector = RepetitionDetector() if self.early_stop else None
+        longest_stop = max((len(stop) for stop in self.stop_sequences), default=0)
+        events = self.client.stream("/v1/chat/completions", payload, stream_timings)
+        try:
+            for event in events:
+                choices = event.get("choices") or []
+                if not choices:
+                    continue
+                finish_reason = choices[0].get("finish_reason") or finish_reason
+                piece = (choices[0].get("delta") or {}).get("content") or choices[0].get("text") or ""
+                if self.abort.is_set():
+                    # Closing the stream drops the connection and frees the slot
+                    raise RuntimeError("cancelled")
+                if not piece:
+                    continue
+                if first is None:
+                    first = time.perf_counter()
+                tokens += 1
+                text += piece
+                if on_token:
+                    on_token(piece)
+                if detector and detector.feed(piece):
+                    text = detector.trimmed()
+                    stopped = "repetition"
+                    break
+                if longest_stop:
+                    window = len(text) - len(piece) - longest_stop
+                    cuts = [text.find(stop, max(0, window)) for stop in self.stop_sequences]
+                    cuts = [cut for cut in cuts if cut >= 0]
+                    if cuts:
+                        text = text[:min(cuts)]
+                        stopped = "stop"
+                        break
+        finally:
+            events.close()
+        end = time.perf_counter()
+        if timings is not None:
+            timings.update(stream_timings)
+            timings["total"] = end - start
+            if first is not None:
+                # Servers send one token per event, so events count tokens
+                timings["ttft"] = first - start
+                timings["completion_tokens"] = tokens
+                timings["generation"] = end - first
+            if stopped:
+                timings["stopped"] = stopped
+                timings["early_stops"] = 1
+            saved = tokens_saved(self.max_length, tokens, stopped is not None)
+            if saved:
+                timings["tokens_saved"] = saved
+        return text, None if stopped else finish_reason
+        
+    def query_tiles(self, tiles: List[str]) -> Optional[str]:
+        """Send tiles concurrently and merge their text in tile order"""
+        texts = [
+            future.result()
+            for _, future in bounded_map(self.query, tiles, self.tile_parallel)
+        ]
+        return merge_tile_texts([text for text in texts if text])
+        
+    def save_result(self, result: str, output_path: str, timings: Optional[dict] = None) -> bool:
+        """Save the processing result to a .txt file, or to self.output if set"""
+        if self.output:
+            try:
+                self.output.write(output_path, result, self.instruction, timings)
+                return True
+            except Exception as e:
+                print(f"Error saving {output_path} to {self.output.path}: {e}")
+                return False
         txt_output_path = os.path.splitext(output_path)[0] + ".txt"
         try:
-            with open(txt_output_path, "w", encoding="utf-8") as output_file:
-                output_file.write(result)
+            write_atomic(txt_output_path, result)
             return True
         except Exception as e:
             print(f"Error saving to {txt_output_path}: {e}")
             return False
         
-def run(api_url, api_password, file_list, instruction):
-    processor = LLMProcessor(api_url, api_password, instruction)
-    try:
-        for i, file_path in enumerate(file_list):
-            result, output_path = processor.process_file(file_path)
-            if result:
-                print(f"----\nFile: {output_path}\n----\nResult: {result}\n")
-                processor.save_result(result, output_path)
-    except Exception as e:
+def _normalize_line(line: str) -> str:
+    return " ".join(line.lower().split())
+
+def _same_line(a: str, b: str) -> bool:
+    a, b = _normalize_line(a), _normalize_line(b)
+    if a == b:
+        return True
+    # Short lines like "Total: 12.50" must match exactly
+    return min(len(a), len(b)) >= 20 and difflib.SequenceMatcher(None, a, b).ratio() >= 0.9
+
+def merge_tile_texts(texts: List[str], max_overlap_lines: int = 8) -> str:
+    """Join tile transcriptions, dropping lines repeated from the overlap
+    
+    For each tile, the longest run of its first lines that matches the last
+    lines merged so far (allowing for small OCR differences) is removed.
+    """
+    merged = []
+    for text in texts:
+        lines = [line for line in text.splitlines() if line.strip()]
+        overlap = 0
+        for k in range(min(max_overlap_lines, len(lines), len(merged)), 0, -1):
+            if all(_same_line(a, b) for a, b in zip(merged[-k:], lines[:k])):
+                overlap = k
+                break
+        merged.extend(lines[overlap:])
+    return "\n".join(merged)
+
+_BATCH_MARKER = re.compile(r"^[ \t]*#{1,4}[ \t]*Image[ \t]+(\d+)[ \t]*:?[ \t]*$", re.IGNORECASE | re.MULTILINE)
+
+def split_batch_answer(text: str, count: int) -> Optional[List[str]]:
+    """Split a reply headed by ### Image N lines into count answers, or None"""
+    parts = _BATCH_MARKER.split(text)
+    numbers = [int(number) for number in parts[1::2]]
+    if numbers != list(range(1, count + 1)):
+        return None
+    return [answer.strip() for answer in parts[2::2]]
+
+def _after(on_token, shown: int):
+    """on_token for a repeated request, skipping the text the first one already passed on"""
+    if on_token is None:
         return None
+    seen = 0
+    def token(piece: str):
+        nonlocal seen
+        start = max(0, shown - seen)
+        seen += len(piece)
+        if start < len(piece):
+            on_token(piece[start:])
+    return token
+
+def describe(info: dict, timings: Optional[dict] = None) -> str:
+    """Short summary of what ImageProcessor and the request reported for one image"""
+    parts = []
+    if "skipped" in info:
+        parts.append(f"skipped as {info['skipped']}")
+    if "duplicate_of" in info:
+        parts.append(f"duplicate of {info['duplicate_of']}")
+    if timings and "batched" in timings:
+        parts.append(f"batch of {timings['batched']}")
+    if "pages" in info:
+        parts.append(f"{info['pages']} pages")
+    if "tiles" in info:
+        parts.append(f"{info['tiles']} tiles")
+    if "tokens" in info:
+        parts.append(f"~{info['tokens']} vision tokens")
+    if "payload_bytes" in info:
+        # Compared with the source file, not a saving: a PNG re-encoded as
+        # JPEG is often sent larger than it is stored
+        source = f" for a {info['source_bytes'] // 1024} KB file" if "source_bytes" in info else ""
+        parts.append(f"{info['payload_bytes'] // 1024} KB sent{source}")
+        parts.append("passed through" if info.get("passthrough") else f"encode {info['encode_ms']:.0f} ms")
+    if timings and "ttft" in timings:
+        rate = timings["completion_tokens"] / max(1e-9, timings["generation"])
+        parts.append(f"ttft {1000 * timings['ttft']:.0f} ms, {rate:.1f} tokens/s")
+    if timings and "tokens_saved" in timings:
+        reason = f" by {timings['stopped']} stop" if "stopped" in timings else ""
+        parts.append(f"{timings['tokens_saved']} tokens saved{reason}")
+    return f" ({', '.join(parts)})" if parts else ""
+
+def build_pipeline(api_url, api_password, instruction, concurrency=None,
+                   decode_workers=None, prefetch=8, connect_timeout=10.0, read_timeout=300.0, retries=3,
+                   cache_path=None, cache_max_mb=256, cache_max_age_days=None,
+                   journal_path=None, image_processor=None,
+                   tile_size=None, tile_overlap=0.15, tile_parallel=4, page_dimension=None,
+                   stream=False, max_tokens=2048, dynamic_max_tokens=False, min_tokens=128,
+                   early_stop=False, stop_sequences=None, raw_workers=None, raw_memory_mb=2048,
+                   endpoints=None, dedup=False, dedup_index=None, dedup_threshold=10, metrics_path=None,
+                   batch_size=1, output_jsonl=None, io_workers=4) -> Pipeline:
+    """Set up the processor, its caches and the pipeline a batch or the service runs on"""
+    if concurrency is None:
+        # Fill every slot the servers have
+        concurrency = sum(endpoint.weight for endpoint in endpoints) if endpoints else 1
+    # With tiling every in-flight page can have tile_parallel requests open
+    connections = concurrency * (tile_parallel if tile_size else 1)
+    processor = LLMProcessor(
+        api_url, api_password, instruction, connections,
+        connect_timeout, read_timeout, retries, endpoints
+    )
+    processor.tile_size = tile_size
+    processor.tile_overlap = tile_overlap
+    processor.tile_parallel = tile_parallel
+    processor.page_dimension = page_dimension
+    processor.stream = stream
+    processor.max_length = max_tokens
+    processor.dynamic_max_tokens = dynamic_max_tokens
+    processor.min_tokens = min_tokens
+    processor.early_stop = early_stop
+    processor.stop_sequences = list(stop_sequences or [])
+    processor.batch_size = batch_size
+    if output_jsonl:
+        processor.output = JsonLinesOutput(output_jsonl)
+    if image_processor:
+        processor.image_processor = image_processor
+    if dynamic_max_tokens:
+        processor.image_processor.measure_text = True
+    processor.metrics = Metrics([JsonLinesHook(metrics_path)] if metrics_path else [])
+    duplicates = None
+    if dedup or dedup_index:
+        processor.image_processor.perceptual_hash = True
+        duplicates = DuplicateIndex(dedup_index, dedup_threshold)
+    if cache_path:
+        processor.cache = ResultCache(cache_path, int(cache_max_mb * 1024 * 1024), cache_max_age_days)
+    journal = Journal(journal_path) if journal_path else None
+    return Pipeline(
+        processor, concurrency, decode_workers, prefetch, journal, raw_workers, raw_memory_mb, duplicates,
+        # One writer keeps the JSON lines in input order
+        io_workers=1 if output_jsonl else io_workers
+    )
+
+def close_pipeline(pipeline: Pipeline):
+    """Print the run's reports and close the files build_pipeline opened"""
+    processor = pipeline.processor
+    processor.metrics.close()
+    print(processor.metrics.report())
+    print(pipeline.report())
+    print(processor.client.report())
+    if pipeline.journal:
+        print(pipeline.journal.report())
+        pipeline.journal.close()
+    if processor.cache:
+        print(processor.cache.report())
+        processor.cache.close()
+    if pipeline.dedup:
+        pipeline.dedup.close()
+    if processor.output:
+        processor.output.close()
+        print(processor.output.report())
+
+def run(api_url, api_password, file_list, instruction, concurrency=None, resume=False, **options):
+    """Process a batch of files; options are those of build_pipeline"""
+    pipeline = build_pipeline(api_url, api_password, instruction, concurrency, **options)
+    if resume and pipeline.journal:
+        file_list = pipeline.journal.remaining(file_list)
+    processor = pipeline.processor
+
+    # Live output only makes sense when answers cannot interleave
+    live = processor.stream and pipeline.concurrency == 1 and not processor.tile_size
+
+    started = set()
+    # Whether streamed text has left the cursor mid-line, as the pages of a
+    # document stream one after another before the document's result
+    mid_line = False
+
+    def on_token(item, text):
+        nonlocal mid_line
+        if item.index not in started:
+            started.add(item.index)
+            page = f" (page {item.page + 1} of {item.pages})" if item.pages else ""
+            print(f"{chr(10) if mid_line else ''}----\nFile: {item.output_path}{page}\n----\nResult: ", end="")
+        print(text, end="", flush=True)
+        mid_line = True
+
+    def on_result(item):
+        nonlocal mid_line
+        mid_line = False
+        if item.error:
+            print(f"Error processing {item.file_path}: {item.error}")
+        elif "skipped" in item.info:
+            print(f"Skipped {item.file_path}: {item.info['skipped']}")
+        elif item.result and live:
+            print(f"\n{describe(item.info, item.timings)}\n")
+        elif item.result:
+            print(f"----\nFile: {item.output_path}{describe(item.info, item.timings)}\n----\nResult: {item.result}\n")
+
+    pipeline.run(file_list, on_result, on_token if live else None)
+    close_pipeline(pipeline)
 
 def main():
     parser = argparse.ArgumentParser(description="LLM OCR")
-    parser.add_argument("--files", default="", help="List of files")
+    parser.add_argument("paths", nargs="*", help="Image files, directories or glob patterns")
+    parser.add_argument("--files", default="", help="Space separated list of files (prefer positional paths)")
+    parser.add_argument("--stdin", action="store_true", help="Also read paths from stdin, one per line")
+    parser.add_argument("-0", "--null", action="store_true", help="Paths on stdin are NUL separated")
+    parser.add_argument(
+        "--no-recursive", dest="recursive", action="store_false", help="Do not descend into subdirectories"
+    )
     parser.add_argument(
         "--api-url", default="http://localhost:5001", help="URL for the LLM API"
     )
     parser.add_argument(
         "--api-password", default="", help="Password for the LLM API"
     )
+    parser.add_argument(
+        "--endpoint", action="append", default=[], metavar="URL[,weight=N][,password=SECRET]",
+        help="Spread requests over several servers (repeatable, replaces --api-url)"
+    )
     parser.add_argument("--instruction", default="Transcribe any text on the image.", help="Instruction for the model")
+    parser.add_argument(
+        "--concurrency", type=int, default=None,
+        help="Number of requests to keep in flight (match the server's multiuser slots; "
+             "default 1, or the total weight of --endpoint servers)"
+    )
+    parser.add_argument(
+        "--decode-workers", type=int, default=None,
+        help="Processes preparing images ahead of the API (0 decodes on the request threads)"
+    )
+    parser.add_argument(
+        "--prefetch", type=int, default=8, help="Maximum number of prepared images waiting to be sent"
+    )
+    parser.add_argument(
+        "--raw-workers", type=int, default=None,
+        help="Processes developing RAW files (0 uses the decode workers)"
+    )
+    parser.add_argument(
+        "--raw-memory-mb", type=float, default=2048,
+        help="Estimated memory RAW files being developed at once may use"
+    )
+    parser.add_argument(
+        "--fast-demosaic", action="store_true",
+        help="Develop RAW files without a thumbnail at half size with bilinear demosaic"
+    )
+    parser.add_argument("--raw-cache", default=None, help="Directory keeping developed RAW images for later runs")
+    parser.add_argument("--connect-timeout", type=float, default=10.0, help="Seconds to wait for a connection")
+    parser.add_argument("--read-timeout", type=float, default=300.0, help="Seconds to wait for the model's response")
+    parser.add_argument(
+        "--retries", type=int, default=3, help="Retries on 429/503 responses and failed connects"
+    )
+    parser.add_argument("--cache", default=None, help="SQLite file caching results of already processed images")
+    parser.add_argument("--cache-max-mb", type=float, default=256, help="Maximum size of cached results")
+    parser.add_argument("--cache-max-age-days", type=float, default=None, help="Drop cached results older than this")
+    parser.add_argument(
+        "--no-fast-decode", dest="fast_decode", action="store_false",
+        help="Always decode images at full resolution before resizing"
+    )
+    parser.add_argument("--max-dimension", type=int, default=896, help="Longest side sent to the model")
+    parser.add_argument(
+        "--sizing", choices=("fixed", "budget"), default="fixed",
+        help="fixed: scale to --max-dimension; budget: fit --token-budget without upscaling"
+    )
+    parser.add_argument("--patch-size", type=int, default=None, help="Vision patch size of the model (default 14)")
+    parser.add_argument("--token-budget", type=int, default=None, help="Maximum vision tokens per image")
+    parser.add_argument(
+        "--adaptive-sizing", action="store_true", help="Give images with little text a smaller token budget"
+    )
+    parser.add_argument(
+        "--encoding", choices=("jpeg", "gray", "bilevel"), default="jpeg",
+        help="Image format sent to the model; gray and bilevel are PNG and suit scanned text"
+    )
+    parser.add_argument("--jpeg-quality", type=int, default=95, help="Quality for --encoding jpeg")
+    parser.add_argument(
+        "--no-passthrough", dest="passthrough", action="store_false",
+        help="Re-encode JPEGs even when they are already the right size"
+    )
+    parser.add_argument(
+        "--triage", action="store_true",
+        help="Skip images a quick local check finds blank or without text, without calling the model"
+    )
+    parser.add_argument(
+        "--triage-skip", nargs="+", choices=Triage.labels, default=["blank", "low_text"],
+        help="Triage labels to skip (default blank low_text)"
+    )
+    parser.add_argument(
+        "--triage-min-contrast", type=float, default=8.0,
+        help="Gray level deviation below which an empty image is blank rather than low_text"
+    )
+    parser.add_argument(
+        "--triage-min-ink", type=float, default=0.00005, help="Fraction of ink pixels below which an image may be empty"
+    )
+    parser.add_argument(
+        "--triage-min-edges", type=float, default=0.00005,
+        help="Fraction of edge pixels below which an image may be empty"
+    )
+    parser.add_argument(
+        "--triage-min-text-cells", type=int, default=2, help="16 pixel cells of print an image needs to count as text"
+    )
+    parser.add_argument(
+        "--first-page-only", dest="multipage", action="store_false",
+        help="Read only the first page of PDFs and the first frame of TIFF and GIF files"
+    )
+    parser.add_argument(
+        "--tile", action="store_true", help="Read large pages as overlapping full-width bands at higher resolution"
+    )
+    parser.add_argument(
+        "--tile-size", type=int, default=None,
+        help="Each band holds the pixels of a square of this side (default --max-dimension)"
+    )
+    parser.add_argument("--tile-overlap", type=float, default=0.15, help="Fraction of a band shared with the next")
+    parser.add_argument("--tile-parallel", type=int, default=4, help="Bands of one page sent at once")
+    parser.add_argument(
+        "--page-dimension", type=int, default=None,
+        help="Scale pages to this longest side before tiling (default 3 tiles)"
+    )
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="Stream tokens as they are generated (printed live with --concurrency 1)"
+    )
+    parser.add_argument("--max-tokens", type=int, default=2048, help="Longest answer the model may generate")
+    parser.add_argument(
+        "--dynamic-max-tokens", action="store_true",
+        help="Size each answer's budget from the amount of text on the image or its previous result"
+    )
+    parser.add_argument("--min-tokens", type=int, default=128, help="Smallest budget --dynamic-max-tokens gives")
+    parser.add_argument(
+        "--early-stop", action="store_true",
+        help="Stream answers and abort them once the model starts repeating itself"
+    )
+    parser.add_argument(
+        "--stop", action="append", default=[], metavar="TEXT",
+        help="End the answer at this text (repeatable)"
+    )
+    parser.add_argument(
+        "--dedup", action="store_true",
+        help="Send only one of each group of near-identical images and copy its result to the others"
+    )
+    parser.add_argument(
+        "--dedup-index", default=None, help="SQLite file of image hashes and results shared across runs (implies --dedup)"
+    )
+    parser.add_argument(
+        "--dedup-threshold", type=int, default=10,
+        help="Differing bits (of 256) for two images to be compared as possible duplicates"
+    )
+    parser.add_argument(
+        "--metrics", default=None, help="Append per-file timings and the run summary to this JSON lines file"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1,
+        help="Images packed into one request, for many small images (answers are split per image)"
+    )
+    parser.add_argument(
+        "--output-jsonl", default=None,
+        help="Append all results to this JSON lines file instead of writing .txt files"
+    )
+    parser.add_argument("--io-workers", type=int, default=4, help="Threads writing .txt files")
+    parser.add_argument("--journal", default=None, help="Append-only log of each file's status")
+    parser.add_argument(
+        "--resume", action="store_true", help="Skip files the journal records as done and retry the rest"
+    )
+    parser.add_argument(
+        "--serve", default=None, metavar="[HOST:]PORT",
+        help="Stay running and take jobs over a local HTTP API instead of processing paths"
+    )
+    parser.add_argument("--socket", default=None, help="Like --serve, on this Unix socket")
+    parser.add_argument(
+        "--service-token", default=os.environ.get("LLMOCR_SERVICE_TOKEN"),
+        help="Token --serve and --socket clients must send (default $LLMOCR_SERVICE_TOKEN; "
+             "--serve makes a random one if unset)"
+    )
+    parser.add_argument(
+        "--allow-remote", action="store_true",
+        help="Let --serve listen on an address other machines can reach"
+    )
     
     args = parser.parse_args()
-    if isinstance(args.files, str):
-        file_list = args.files.split(" ")
-    else:
+    try:
+        endpoints = [Endpoint.parse(spec) for spec in args.endpoint]
+    except ValueError as e:
+        parser.error(str(e))
+    if args.resume and not args.journal:
+        parser.error("--resume needs --journal")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    service = args.serve or args.socket
+    host, port = "127.0.0.1", None
+    if args.serve:
+        host, _, port = args.serve.rpartition(":")
+        try:
+            port = int(port)
+        except ValueError:
+            parser.error("--serve needs a port, e.g. --serve 8765 or --serve 127.0.0.1:8765")
+        host = host or "127.0.0.1"
+    sources = list(args.paths)
+    if args.files:
+        sources.extend(args.files.split(" "))
+    if args.socket and not hasattr(socket, "AF_UNIX"):
+        parser.error("--socket needs Unix sockets, which this platform lacks; use --serve")
+    if service and (sources or args.stdin):
+        parser.error("--serve and --socket take paths as jobs over the API, not on the command line")
+    options = dict(
+        concurrency=args.concurrency,
+        decode_workers=args.decode_workers,
+        prefetch=args.prefetch,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        retries=args.retries,
+        cache_path=args.cache,
+        cache_max_mb=args.cache_max_mb,
+        cache_max_age_days=args.cache_max_age_days,
+        journal_path=args.journal,
+        image_processor=ImageProcessor(
+            max_dimension=args.max_dimension,
+            fast_decode=args.fast_decode,
+            sizing=args.sizing,
+            patch_size=args.patch_size,
+            token_budget=args.token_budget,
+            adaptive=args.adaptive_sizing,
+            encoding=args.encoding,
+            jpeg_quality=args.jpeg_quality,
+            passthrough=args.passthrough,
+            fast_demosaic=args.fast_demosaic,
+            raw_cache=RawCache(args.raw_cache) if args.raw_cache else None,
+            multipage=args.multipage,
+            triage=Triage(
+                args.triage_min_contrast, args.triage_min_ink, args.triage_min_edges,
+                args.triage_min_text_cells, skip=tuple(args.triage_skip)
+            ) if args.triage else None,
+        ),
+        tile_size=(args.tile_size or args.max_dimension) if args.tile else None,
+        tile_overlap=args.tile_overlap,
+        tile_parallel=args.tile_parallel,
+        page_dimension=args.page_dimension,
+        stream=args.stream,
+        max_tokens=args.max_tokens,
+        dynamic_max_tokens=args.dynamic_max_tokens,
+        min_tokens=args.min_tokens,
+        early_stop=args.early_stop,
+        stop_sequences=args.stop,
+        raw_workers=args.raw_workers,
+        raw_memory_mb=args.raw_memory_mb,
+        endpoints=endpoints,
+        dedup=args.dedup,
+        dedup_index=args.dedup_index,
+        dedup_threshold=args.dedup_threshold,
+        metrics_path=args.metrics,
+        batch_size=args.batch_size,
+        output_jsonl=args.output_jsonl,
+        io_workers=args.io_workers,
+    )
+    if service:
+        # Imported only here, so a platform without Unix sockets can still run batches
+        from service import is_loopback, serve
+        if args.serve and not args.allow_remote and not is_loopback(host):
+            parser.error(f"--serve {host} is reachable from other machines; add --allow-remote to mean it")
+        pipeline = build_pipeline(args.api_url, args.api_password, args.instruction, **options)
+        serve(pipeline, host, port, args.socket, args.service_token, args.allow_remote)
+        close_pipeline(pipeline)
         return
-        
-    run(args.api_url, args.api_password, file_list, args.instruction)
+    file_list = iter_files(
+        sources, ImageProcessor(), args.recursive,
+        sys.stdin if args.stdin else None, args.null
+    )
+    run(args.api_url, args.api_password, file_list, args.instruction, resume=args.resume, **options)
     
 if __name__ == "__main__":
     main()
@@ -0,0 +1,241 @@
+import threading
+import time
+from typing import Iterator, List, Optional, Tuple
+
+import requests
+
+from api_client import ApiClient
+
+
+class Endpoint:
+    """ One API server in a LoadBalancer pool
+
+    weight is how many requests the server handles at once (its multiuser
+    slots). Counters cover every request sent to it.
+    """
+    def __init__(self, url: str, password: str = "", weight: int = 1):
+        if weight < 1:
+            raise ValueError("weight must be at least 1")
+        self.url = url.rstrip("/")
+        self.password = password
+        self.weight = weight
+        self.client = None
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.completion_tokens = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self.first_request = None
+        self.last_request = None
+
+    @classmethod
+    def parse(cls, spec: str) -> "Endpoint":
+        """ Build from "URL[,weight=N][,password=SECRET]"
+        """
+        url, *options = spec.split(",")
+        settings = {}
+        for option in options:
+            key, _, value = option.partition("=")
+            if key not in ("weight", "password"):
+                raise ValueError(f"Unknown endpoint option {key!r} in {spec!r}")
+            settings[key] = value
+        return cls(url, settings.get("password", ""), int(settings.get("weight", 1)))
+
+    @property
+    def load(self) -> float:
+        return self.in_flight / self.weight
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.down_until
+
+    def summary(self) -> dict:
+        elapsed = (self.last_request or 0) - (self.first_request or 0)
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": round(self.errors / self.requests, 3) if self.requests else 0.0,
+            "mean_ms": round(1000 * self.busy / self.requests, 1) if self.requests else 0.0,
+            "requests_per_sec": round(self.requests / elapsed, 2) if elapsed > 0 else None,
+            "completion_tokens": self.completion_tokens,
+        }
+
+
+class LoadBalancer:
+    """ Spread requests over several OpenAI compatible servers
+
+    Drop-in replacement for ApiClient. Each request goes to the healthy
+    endpoint with the fewest requests in flight per unit of weight. A request
+    that fails with a connection error, timeout or 5xx/429 is retried on
+    another endpoint, and the failing endpoint is skipped for `cooldown`
+    seconds, doubling with each consecutive failure up to `max_cooldown`.
+    Health is judged from real requests only; once its cooldown has passed an
+    endpoint is tried again. A stream is only moved to another endpoint
+    before its first event arrives.
+    """
+    def __init__(self, endpoints: List[Endpoint], pool_size: int = 1, connect_timeout: float = 10.0,
+                 read_timeout: float = 300.0, retries: int = 3,
+                 cooldown: float = 5.0, max_cooldown: float = 120.0):
+        if not endpoints:
+            raise ValueError("at least one endpoint is required")
+        self.endpoints = endpoints
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        # Every endpoint gets a chance before one is tried twice
+        self.attempts = max(len(endpoints), retries + 1)
+        for endpoint in endpoints:
+            # One quick retry for dropped keep-alive connections; anything
+            # worse fails over to another endpoint instead
+            endpoint.client = ApiClient(
+                endpoint.url, endpoint.password, pool_size=max(pool_size, endpoint.weight),
+                connect_timeout=connect_timeout, read_timeout=read_timeout, retries=min(retries, 1)
+            )
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self) -> int:
+        return sum(endpoint.weight for endpoint in self.endpoints)
+
+    def _acquire(self, tried: set, count: bool = True) -> Endpoint:
+        """ Pick the least loaded healthy endpoint, preferring ones not yet tried
+
+        When every endpoint is cooling down this waits for the first to recover.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                candidates = [e for e in self.endpoints if e.healthy(now) and id(e) not in tried]
+                if not candidates:
+                    candidates = [e for e in self.endpoints if e.healthy(now)]
+                if candidates:
+                    endpoint = min(candidates, key=lambda e: (e.load, e.requests / e.weight))
+                    tried.add(id(endpoint))
+                    endpoint.in_flight += 1
+                    if count:
+                        endpoint.requests += 1
+                        if endpoint.first_request is None:
+                            endpoint.first_request = now
+                    return endpoint
+                delay = min(e.down_until for e in self.endpoints) - now
+            time.sleep(delay)
+
+    def _release(self, endpoint: Endpoint, start: float, error: Optional[Exception] = None,
+                 timings: Optional[dict] = None):
+        with self._lock:
+            now = time.monotonic()
+            endpoint.in_flight -= 1
+            endpoint.busy += time.perf_counter() - start
+            endpoint.last_request = now
+            if timings:
+                endpoint.completion_tokens += int(timings.get("completion_tokens", 0))
+            if error is None:
+                endpoint.failures = 0
+                return
+            endpoint.errors += 1
+            if _retryable(error):
+                endpoint.failures += 1
+                endpoint.down_until = now + min(
+                    self.max_cooldown, self.cooldown * 2 ** (endpoint.failures - 1)
+                )
+
+    def post(self, path: str, payload: dict) -> Tuple[dict, dict]:
+        """ ApiClient.post on the least loaded endpoint, failing over on errors
+        """
+        tried = set()
+        for attempt in range(self.attempts):
+            endpoint = self._acquire(tried)
+            start = time.perf_counter()
+            try:
+                response_json, timings = endpoint.client.post(path, payload)
+            except Exception as e:
+                self._release(endpoint, start, e)
+                if not _retryable(e) or attempt == self.attempts - 1:
+                    raise
+                continue
+            usage = response_json.get("usage") or {}
+            self._release(endpoint, start, timings=usage)
+            timings["endpoint"] = endpoint.url
+            return response_json, timings
+
+    def stream(self, path: str, payload: dict, timings: Optional[dict] = None) -> Iterator[dict]:
+        """ ApiClient.stream on the least loaded endpoint
+
+        Fails over to another endpoint until the first event has arrived.
+        """
+        tried = set()
+        for attempt in range(self.attempts):
+            endpoint = self._acquire(tried)
+            start = time.perf_counter()
+            events = endpoint.client.stream(path, payload, timings)
+            try:
+                first = next(events, None)
+            except Exception as e:
+                self._release(endpoint, start, e)
+                if not _retryable(e) or attempt == self.attempts - 1:
+                    raise
+                continue
+            if timings is not None:
+                timings["endpoint"] = endpoint.url
+            count = 0
+            error = None
+            try:
+                if first is not None:
+                    count += 1
+                    yield first
+                for event in events:
+                    count += 1
+                    yield event
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                events.close()
+                self._release(endpoint, start, error, {"completion_tokens": count})
+            return
+
+    def get(self, path: str) -> dict:
+        tried = set()
+        for attempt in range(self.attempts):
+            # Metadata lookups are not counted as requests
+            endpoint = self._acquire(tried, count=False)
+            start = time.perf_counter()
+            try:
+                response_json = endpoint.client.get(path)
+            except Exception as e:
+                self._release(endpoint, start, e)
+                if not _retryable(e) or attempt == self.attempts - 1:
+                    raise
+                continue
+            self._release(endpoint, start)
+            return response_json
+
+    def abort(self):
+        for endpoint in self.endpoints:
+            endpoint.client.abort()
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.client.close()
+
+    def report(self) -> str:
+        lines = []
+        for endpoint in self.endpoints:
+            s = endpoint.summary()
+            rate = f"{s['requests_per_sec']} req/s" if s["requests_per_sec"] is not None else "- req/s"
+            lines.append(
+                f"endpoint: {s['url']} (weight {s['weight']}): {s['requests']} requests, "
+                f"{s['errors']} errors ({100 * s['error_rate']:.1f}%), mean {s['mean_ms']} ms, {rate}"
+            )
+            lines.append(endpoint.client.report())
+        return "\n".join(lines)
+
+
+def _retryable(error: Exception) -> bool:
+    """ Whether another server might succeed where this one failed
+    """
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
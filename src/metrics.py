@@ -0,0 +1,195 @@
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+# Per-file spans in milliseconds: keys ImageProcessor reports in info...
+INFO_SPANS = ("prepare_ms", "decode_ms", "demosaic_ms", "resize_ms", "triage_ms", "encode_ms")
+# ...and request timings LLMProcessor reports in seconds, with their names
+TIMING_SPANS = {
+    "connect": "connect_ms",
+    "ttfb": "ttfb_ms",
+    "ttft": "ttft_ms",
+    "generation": "generation_ms",
+    "total": "request_ms",
+}
+COUNTS = {
+    "source_bytes": "source_bytes",
+    "payload_bytes": "payload_bytes",
+    "base64_bytes": "base64_bytes",
+    "tokens": "vision_tokens",
+    "tiles": "tiles",
+    "pages": "pages",
+    "completion_tokens": "completion_tokens",
+    "tokens_saved": "tokens_saved",
+}
+LABELS = ("endpoint", "stopped", "duplicate_of", "triage", "skipped")
+
+
+def percentiles(values, points=(50, 95, 99)) -> dict:
+    """ Nearest-rank percentiles of a list of numbers
+    """
+    if not values:
+        return {f"p{p}": None for p in points}
+    ordered = sorted(values)
+    return {
+        f"p{p}": ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+        for p in points
+    }
+
+
+class MetricsHook:
+    """ Base class for collectors of per-file metrics
+
+    Subclass and override what you need; hooks are called from the thread
+    that finished the file, so they should return quickly.
+    """
+    def on_record(self, record: dict):
+        pass
+
+    def on_summary(self, summary: dict):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonLinesHook(MetricsHook):
+    """ Append each file's record, then the run summary, as JSON lines
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def on_record(self, record: dict):
+        line = json.dumps(record)
+        with self._lock:
+            # Left to the file buffer; flushed on close
+            self._file.write(line + "\n")
+
+    def on_summary(self, summary: dict):
+        with self._lock:
+            self._file.write(json.dumps({"summary": summary}) + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Metrics:
+    """ Per-file spans and counters, passed to hooks and summarised at the end
+
+    A record is built from the info dict ImageProcessor fills and the timings
+    dict LLMProcessor fills, plus whatever spans the caller adds (e.g. write_ms).
+    Only the numbers needed for percentiles are kept, so this is cheap enough
+    to leave on.
+    """
+    def __init__(self, hooks: Iterable[MetricsHook] = ()):
+        self.hooks: List[MetricsHook] = list(hooks)
+        self.statuses = {}
+        self.spans = {}
+        self.totals = {}
+        self.start = time.time()
+        self.end = None
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook: MetricsHook):
+        self.hooks.append(hook)
+
+    def record(self, file_path, status: str, info: Optional[dict] = None,
+               timings: Optional[dict] = None, **spans) -> dict:
+        """ Record one finished file; status is e.g. done, failed or cached
+
+        Extra keyword arguments are added to the record as they are, numbers
+        ending in _ms also count towards the span percentiles.
+        """
+        info = info or {}
+        timings = timings or {}
+        record = {"path": str(file_path), "status": status, "time": round(time.time(), 3)}
+        for key in INFO_SPANS:
+            if key in info:
+                record[key] = info[key]
+        for key, name in TIMING_SPANS.items():
+            if key in timings:
+                record[name] = round(1000 * timings[key], 2)
+        for name, value in spans.items():
+            if value is not None:
+                record[name] = round(value, 2) if isinstance(value, float) else value
+        for key, name in COUNTS.items():
+            value = info.get(key, timings.get(key))
+            if value is not None:
+                record[name] = value
+        for key in LABELS:
+            value = info.get(key, timings.get(key))
+            if value is not None:
+                record[key] = str(value) if isinstance(value, Path) else value
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.end = time.time()
+            for key, value in record.items():
+                if key.endswith("_ms"):
+                    self.spans.setdefault(key, []).append(value)
+                elif key in COUNTS.values():
+                    self.totals[key] = self.totals.get(key, 0) + value
+        for hook in self.hooks:
+            hook.on_record(record)
+        return record
+
+    def summary(self) -> dict:
+        with self._lock:
+            files = sum(self.statuses.values())
+            seconds = (self.end or time.time()) - self.start
+            summary = {
+                "files": files,
+                "statuses": dict(self.statuses),
+                "seconds": round(seconds, 3),
+                "files_per_sec": round(files / seconds, 3) if seconds > 0 else None,
+                "totals": dict(self.totals),
+                "spans": {},
+            }
+            for key, values in self.spans.items():
+                entry = {k: round(v, 2) for k, v in percentiles(values).items()}
+                entry["mean"] = round(sum(values) / len(values), 2)
+                entry["count"] = len(values)
+                summary["spans"][key] = entry
+            if seconds > 0 and "completion_tokens" in self.totals:
+                summary["completion_tokens_per_sec"] = round(self.totals["completion_tokens"] / seconds, 2)
+        return summary
+
+    def roll(self) -> dict:
+        """ Send the summary so far to every hook and start over, for
+            processes that never finish a run
+        """
+        summary = self.summary()
+        with self._lock:
+            self.statuses = {}
+            self.spans = {}
+            self.totals = {}
+            self.start = time.time()
+            self.end = None
+        for hook in self.hooks:
+            hook.on_summary(summary)
+        return summary
+
+    def close(self) -> dict:
+        """ Send the summary to every hook and close them
+        """
+        summary = self.summary()
+        for hook in self.hooks:
+            hook.on_summary(summary)
+            hook.close()
+        return summary
+
+    def report(self) -> str:
+        s = self.summary()
+        statuses = ", ".join(f"{count} {status}" for status, count in sorted(s["statuses"].items()))
+        rate = f"{s['files_per_sec']} files/s" if s["files_per_sec"] is not None else "- files/s"
+        lines = [f" metrics: {s['files']} files ({statuses}) in {s['seconds']} s, {rate}"]
+        for key, entry in s["spans"].items():
+            lines.append(
+                f"{key[:-3]:>12}: p50 {entry['p50']} ms, p95 {entry['p95']} ms, "
+                f"p99 {entry['p99']} ms, mean {entry['mean']} ms"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,797 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Tuple, Any, Optional
+
+
+def bounded_map(fn: Callable, items: Iterable, concurrency: int = 1) -> Iterator[Tuple[Any, Any]]:
+    """ Run fn over items on a thread pool, yielding (item, future) in input order
+
+    At most `concurrency` calls run at once and at most `concurrency` more are
+    queued behind them, so items are consumed lazily and a slow head item does
+    not leave the other workers idle.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    window = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            for item in items:
+                window.append((item, executor.submit(fn, item)))
+                if len(window) >= concurrency * 2:
+                    yield window.popleft()
+            while window:
+                yield window.popleft()
+        finally:
+            for _, future in window:
+                future.cancel()
+
+
+class StageStats:
+    """ Latency and queue depth counters for one pipeline stage
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.max_latency = 0.0
+        self.wait = 0.0
+        self.depth_total = 0
+        self.depth_samples = 0
+        self.max_depth = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, error: bool = False):
+        """ Record one processed item and how long the stage spent on it
+
+        A failed item only counts as an error; count and the latencies
+        cover the items the stage completed.
+        """
+        with self._lock:
+            if error:
+                self.errors += 1
+                return
+            self.count += 1
+            self.busy += seconds
+            self.max_latency = max(self.max_latency, seconds)
+
+    def waited(self, seconds: float):
+        """ Record time spent blocked waiting on the previous stage
+        """
+        with self._lock:
+            self.wait += seconds
+
+    def observe_depth(self, depth: int):
+        """ Sample the number of items queued in front of this stage
+        """
+        with self._lock:
+            self.depth_total += depth
+            self.depth_samples += 1
+            self.max_depth = max(self.max_depth, depth)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "stage": self.name,
+                "count": self.count,
+                "errors": self.errors,
+                "mean_ms": round(1000 * self.busy / self.count, 1) if self.count else 0.0,
+                "max_ms": round(1000 * self.max_latency, 1),
+                "wait_s": round(self.wait, 2),
+                "mean_depth": round(self.depth_total / self.depth_samples, 1) if self.depth_samples else 0.0,
+                "max_depth": self.max_depth,
+            }
+
+
+class MemoryBudget:
+    """ Admit work while its estimated memory fits under a limit
+
+    acquire blocks until `amount` more bytes fit. A single request larger than
+    the limit is still let through once nothing else is running.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, amount: int):
+        with self._cond:
+            while self.used and self.used + amount > self.limit:
+                self._cond.wait()
+            self.used += amount
+            self.peak = max(self.peak, self.used)
+
+    def release(self, amount: int):
+        with self._cond:
+            self.used -= amount
+            self._cond.notify_all()
+
+
+# Ends every page of a document's transcript but the last, like the form
+# feeds pdftotext writes
+PAGE_SEPARATOR = "\n\f"
+
+# Per page values that add up over a document: counts, sizes and spans of
+# work. Everything else (ttft, ttfb, batch size, dimensions...) describes one
+# request or image, so a document reports its mean over the pages
+ADDITIVE = {
+    "tokens", "tiles", "completion_tokens", "tokens_saved", "early_stops", "budget_retries", "generation",
+    "duplicates", "passthrough", "raw_developed", "raw_reused",
+}
+
+
+def _additive(key: str) -> bool:
+    return key in ADDITIVE or key.endswith(("_ms", "_bytes"))
+
+
+def _share(timings: dict, number: int, count: int) -> dict:
+    """The part of a batched request's timings that belongs to its number-th
+    image: additive values are split count ways (whole counts so they still
+    sum to the batch's), per request ones such as ttft are shared as is"""
+    share = {}
+    for key, value in timings.items():
+        if not _additive(key) or isinstance(value, bool) or not isinstance(value, (int, float)):
+            share[key] = value
+        elif isinstance(value, int):
+            share[key] = value // count + (number < value % count)
+        else:
+            share[key] = value / count
+    return share
+
+
+def _prepare(image_processor, file_path, tiling=None, page=None):
+    """ Decode and encode one image, or its list of tiles when tiling is a
+        (tile_size, overlap, page_dimension) tuple; runs in a worker process
+
+    page picks one page or frame of a multi-page file.
+    """
+    start = time.perf_counter()
+    info = {}
+    if tiling:
+        image = image_processor.tile_image(str(file_path), *tiling, info=info, page=page)
+        output_path = Path(file_path)
+    else:
+        image, output_path = image_processor.process_image(str(file_path), info, page)
+    return image, output_path, time.perf_counter() - start, info
+
+
+class WorkItem:
+    """ One file, or one page of a multi-page file, moving through the pipeline
+
+    index orders items through the pipeline, file_index is the position of
+    the file in the input. Pages have page set and pages to the page count.
+    """
+    __slots__ = (
+        "index", "file_index", "file_path", "output_path", "future", "cache_key", "result", "error",
+        "started", "cancelled", "cached", "info", "timings", "page", "pages",
+    )
+
+    def __init__(self, index: int, file_path, file_index: Optional[int] = None):
+        self.index = index
+        self.file_index = index if file_index is None else file_index
+        self.file_path = file_path
+        self.page = None
+        self.pages = None
+        self.started = time.perf_counter()
+        self.cancelled = False
+        self.cached = False
+        self.info = {}
+        self.timings = {}
+        self.output_path = None
+        self.future = None
+        self.cache_key = None
+        self.result = None
+        self.error = None
+
+
+class Pipeline:
+    """ Three stage producer/consumer pipeline around an LLMProcessor
+
+    decode:  a process pool prepares images ahead of the network stage, bounded
+             by `prefetch` so memory stays flat on large batches; RAW files
+             go to their own pool of `raw_workers` processes, admitted while
+             their estimated demosaic memory fits in `raw_memory_mb`
+    network: `concurrency` threads send ready payloads to the API
+    write:   a single thread puts results back in input order and saves them
+             through `io_workers` threads, each .txt written atomically
+
+    Each page of a PDF and each frame of a multi-frame TIFF or GIF is its own
+    work item: pages are rendered only as the decode stage reaches them and
+    share the network threads with everything else, and the write stage
+    joins them back into one transcript per document.
+    When the processor has a result cache, hits skip straight to the write stage.
+    With a dedup index, an image whose perceptual hash matches one already
+    sent waits for that result instead of calling the model. When the
+    processor's batch_size is above 1, each network thread packs up to that
+    many ready images into one request.
+    A failed file is reported and recorded in the journal, if one is given, and
+    the batch carries on with the next file.
+    """
+    def __init__(self, processor, concurrency: int = 1,
+                 decode_workers: Optional[int] = None, prefetch: int = 8, journal=None,
+                 raw_workers: Optional[int] = None, raw_memory_mb: float = 2048, dedup=None,
+                 batch_wait: float = 0.05, io_workers: int = 4):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        if prefetch < 1:
+            raise ValueError("prefetch must be at least 1")
+        if io_workers < 1:
+            raise ValueError("io_workers must be at least 1")
+        self.processor = processor
+        self.concurrency = concurrency
+        self.decode_workers = decode_workers if decode_workers is not None else min(4, os.cpu_count() or 1)
+        self.prefetch = prefetch
+        self.journal = journal
+        self.raw_workers = raw_workers if raw_workers is not None else min(2, os.cpu_count() or 1)
+        self.raw_memory = MemoryBudget(int(raw_memory_mb * 1024 * 1024))
+        self.dedup = dedup
+        self.batch_wait = batch_wait
+        self.io_workers = io_workers
+        self._settings_key = None
+        self.stats = {name: StageStats(name) for name in ("decode", "network", "write")}
+        # Sums of the numeric values ImageProcessor reports per image
+        self.totals = {}
+        self._totals_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def stop(self, cancel: bool = False):
+        """ Stop feeding new files; queued items not yet sent are skipped
+
+        With cancel, requests in flight are aborted as well. Their files are
+        left out of the results, like skipped ones, and stay pending in the
+        journal so a resumed run picks them up.
+        """
+        self._stop.set()
+        if cancel:
+            self.processor.cancel()
+
+    def _aborted(self, item: WorkItem, error: Exception) -> bool:
+        """ Whether a request failed because stop(cancel=True) aborted it
+        """
+        item.error = error
+        item.cancelled = self._stop.is_set() and self.processor.abort.is_set()
+        return item.cancelled
+
+    def _make_decoder(self):
+        if self.decode_workers > 0:
+            return ProcessPoolExecutor(max_workers=self.decode_workers)
+        return ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def _make_raw_decoder(self):
+        if self.raw_workers > 0:
+            return ProcessPoolExecutor(max_workers=self.raw_workers)
+        return nullcontext()
+
+    def _submit(self, decoder, raw_decoder, file_path, tiling, page=None):
+        """ Queue one file (or page) for decoding, RAW files on their own
+            memory bounded pool
+        """
+        image_processor = self.processor.image_processor
+        try:
+            memory = image_processor.raw_memory_estimate(file_path) if raw_decoder else 0
+        except OSError:
+            # Let the decode stage report the missing file
+            memory = 0
+        if not memory:
+            return decoder.submit(_prepare, image_processor, file_path, tiling, page)
+        self.raw_memory.acquire(memory)
+        future = raw_decoder.submit(_prepare, image_processor, file_path, tiling)
+        future.add_done_callback(lambda _: self.raw_memory.release(memory))
+        return future
+
+    def _partial_path(self, item: WorkItem) -> str:
+        base = os.path.splitext(str(item.output_path))[0]
+        if item.pages:
+            return f"{base}.page{item.page + 1}.txt.part"
+        return base + ".txt.part"
+
+    def _max_tokens(self, item: WorkItem) -> Optional[int]:
+        # A document's earlier transcript says nothing about one page of it
+        return self.processor.max_tokens_for(item.info, None if item.pages else item.output_path)
+
+    def _sidecars(self) -> bool:
+        # Results going to a JSONL file leave no .txt files beside the images
+        return self.processor.stream and self.processor.output is None
+
+    def _remove_partial(self, item: WorkItem):
+        if self._sidecars() and item.output_path:
+            try:
+                os.remove(self._partial_path(item))
+            except OSError:
+                pass
+
+    def _query_streaming(self, item: WorkItem, image, on_token: Optional[Callable],
+                         max_tokens: Optional[int] = None):
+        """ Stream the answer into a .txt.part sidecar (and on_token) as it arrives
+        """
+        with open(self._partial_path(item), "w", encoding="utf-8") as partial:
+            def token(text):
+                partial.write(text)
+                partial.flush()
+                if on_token:
+                    on_token(item, text)
+            return self.processor.query(image, item.timings, on_token=token, max_tokens=max_tokens)
+
+    def _take(self, ready: queue.Queue):
+        """ Next batch of up to processor.batch_size items, and whether the
+            end of the queue was reached
+        """
+        item = ready.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        while len(batch) < self.processor.batch_size:
+            try:
+                # Linger briefly so a batch can fill while decodes finish
+                item = ready.get(timeout=self.batch_wait)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _receive(self, item: WorkItem, done: queue.Queue):
+        """ Wait for an item's decode; None if it was cancelled or failed
+        """
+        decode, network = self.stats["decode"], self.stats["network"]
+        if self._stop.is_set():
+            item.future.cancel()
+            item.cancelled = True
+            done.put(item)
+            return None
+        try:
+            start = time.perf_counter()
+            image, item.output_path, decode_time, item.info = item.future.result()
+            network.waited(time.perf_counter() - start)
+            decode.record(decode_time)
+            item.info["prepare_ms"] = round(1000 * decode_time, 2)
+            if isinstance(image, str):
+                item.info["base64_bytes"] = len(image)
+            self._add_totals(item.info)
+            return image
+        except Exception as e:
+            decode.record(0.0, error=True)
+            item.error = e
+            done.put(item)
+            return None
+        finally:
+            item.future = None
+
+    def _send(self, item: WorkItem, image, on_token: Optional[Callable]):
+        network = self.stats["network"]
+        start = time.perf_counter()
+        try:
+            max_tokens = self._max_tokens(item)
+            if isinstance(image, list):
+                item.result = self.processor.query_tiles(image)
+            elif self._sidecars():
+                item.result = self._query_streaming(item, image, on_token, max_tokens)
+            elif self.processor.stream:
+                token = (lambda text: on_token(item, text)) if on_token else None
+                item.result = self.processor.query(image, item.timings, on_token=token, max_tokens=max_tokens)
+            else:
+                item.result = self.processor.query(image, item.timings, max_tokens=max_tokens)
+            network.record(time.perf_counter() - start)
+            self._add_totals(item.timings)
+        except Exception as e:
+            if self._aborted(item, e):
+                self._remove_partial(item)
+            else:
+                network.record(time.perf_counter() - start, error=True)
+
+    def _send_batch(self, items: list, images: list):
+        """ Send several images in one request, one at a time if the answer
+            cannot be split
+        """
+        network = self.stats["network"]
+        start = time.perf_counter()
+        max_tokens = sum(
+            self._max_tokens(item) or self.processor.max_length
+            for item in items
+        )
+        timings = {}
+        try:
+            results = self.processor.query_batch(images, timings, max_tokens)
+        except Exception as e:
+            for item in items:
+                if not self._aborted(item, e):
+                    network.record(time.perf_counter() - start, error=True)
+            return
+        if results is None:
+            self._add_totals({"batch_fallbacks": 1})
+            for item, image in zip(items, images):
+                self._send(item, image, None)
+            return
+        for number, (item, result) in enumerate(zip(items, results)):
+            item.result = result
+            # Each image gets its share of the request, so per-file figures
+            # add up to the batch rather than counting it once per image
+            item.timings.update(_share(timings, number, len(items)), batched=len(items))
+            network.record(time.perf_counter() - start)
+        self._add_totals(dict(timings, batches=1, batched=len(items)))
+
+    def _network_worker(self, ready: queue.Queue, done: queue.Queue, on_token: Optional[Callable]):
+        network = self.stats["network"]
+        finished = False
+        while not finished:
+            batch, finished = self._take(ready)
+            network.observe_depth(ready.qsize())
+            sends, followers, clusters = [], [], []
+            for item in batch:
+                image = self._receive(item, done)
+                if item.cancelled or item.error:
+                    continue
+                if "skipped" in item.info:
+                    # Triage found nothing worth reading
+                    self._add_totals({"calls_avoided": 1, f"skipped_{item.info['triage']}": 1})
+                    done.put(item)
+                    continue
+                if self.dedup and "dhash" in item.info:
+                    try:
+                        cluster, leader = self.dedup.claim(
+                            item.info["dhash"], item.info["fingerprint"], self._settings_key, item.file_path
+                        )
+                    except Exception as e:
+                        # e.g. a locked or broken index; fail the item, not the thread
+                        item.error = e
+                        done.put(item)
+                        continue
+                    if not leader:
+                        followers.append((item, image, cluster))
+                        continue
+                    if cluster is not None:
+                        clusters.append((item, cluster))
+                sends.append((item, image))
+            # Single images only; tiles, streams and empty payloads go one by one
+            packed = [
+                (item, image) for item, image in sends
+                if isinstance(image, str) and image and not self.processor.stream
+            ]
+            if len(packed) < 2:
+                packed = []
+            else:
+                self._send_batch([item for item, _ in packed], [image for _, image in packed])
+            batched = {id(item) for item, _ in packed}
+            for item, image in sends:
+                if id(item) not in batched:
+                    self._send(item, image, on_token)
+            for item, cluster in clusters:
+                try:
+                    self.dedup.resolve(cluster, None if item.error else item.result, self._settings_key)
+                except Exception as e:
+                    item.error = e
+                    # Followers send their own requests instead of waiting forever
+                    cluster.resolve(None)
+            # Followers wait only after this batch is sent, so a leader in the
+            # same batch cannot deadlock them
+            for item, image, cluster in followers:
+                start = time.perf_counter()
+                item.result = cluster.wait()
+                network.waited(time.perf_counter() - start)
+                if item.result is not None:
+                    item.info["duplicate_of"] = cluster.source
+                    item.timings["duplicates"] = 1
+                    self._add_totals(item.timings)
+                else:
+                    # The leader failed; send this one after all
+                    self._send(item, image, on_token)
+            for item, _ in sends:
+                done.put(item)
+            for item, _, _ in followers:
+                done.put(item)
+
+    def _add_totals(self, info: dict):
+        with self._totals_lock:
+            for key, value in info.items():
+                if isinstance(value, (int, float)):
+                    self.totals[key] = self.totals.get(key, 0) + value
+
+    def _save(self, item: WorkItem) -> Optional[Exception]:
+        """ Write one result; runs on the I/O threads
+        """
+        self._remove_partial(item)
+        if item.result and not self.processor.save_result(item.result, item.output_path, item.timings):
+            return OSError(f"Could not save result for {item.file_path}")
+        return None
+
+    def _finish(self, item: WorkItem, start: float, saved, on_result: Optional[Callable]):
+        """ Record a written item, in input order
+        """
+        try:
+            error = saved.result()
+        except Exception as e:
+            error = e
+        if error:
+            item.error = error
+        elif item.result and self.processor.cache and item.cache_key:
+            self.processor.cache.put(item.cache_key, item.result)
+        if self.journal:
+            self.journal.record(
+                item.file_path, "failed" if item.error else "done",
+                time.perf_counter() - item.started, str(item.error) if item.error else None,
+                skipped=item.info.get("skipped")
+            )
+        if self.processor.metrics:
+            self.processor.metrics.record(
+                item.file_path, self.status(item), item.info, item.timings,
+                write_ms=1000 * (time.perf_counter() - start),
+                duration_ms=1000 * (time.perf_counter() - item.started),
+                error=str(item.error) if item.error else None,
+            )
+        if on_result:
+            try:
+                on_result(item)
+            except Exception as e:
+                # A failing callback must not stop the results after this one
+                item.error = item.error or e
+                self.stats["write"].record(time.perf_counter() - start, error=True)
+                return
+        self.stats["write"].record(time.perf_counter() - start)
+
+    def _writer(self, done: queue.Queue, on_result: Optional[Callable]):
+        """ Put results back in input order and save them
+
+        Saves run on `io_workers` threads so slow file systems can have
+        several writes in flight, while the journal, metrics and on_result
+        still see items in order.
+        """
+        write = self.stats["write"]
+        pending = {}
+        next_index = 0
+        window = deque()
+        # Pages of unfinished documents by file_index; with a schedule the
+        # pages of several documents can be interleaved
+        documents = {}
+        with ThreadPoolExecutor(max_workers=self.io_workers) as io:
+            while True:
+                item = done.get()
+                if item is None:
+                    break
+                write.observe_depth(done.qsize())
+                pending[item.index] = item
+                while next_index in pending:
+                    item = pending.pop(next_index)
+                    next_index += 1
+                    if item.cancelled:
+                        continue
+                    if item.pages:
+                        # Hold pages back until their document is complete
+                        self._remove_partial(item)
+                        pages = documents.setdefault(item.file_index, [])
+                        pages.append(item)
+                        if len(pages) < item.pages:
+                            continue
+                        item = self._join_pages(documents.pop(item.file_index))
+                    window.append((item, time.perf_counter(), io.submit(self._save, item)))
+                    while window and (window[0][2].done() or len(window) > self.io_workers):
+                        self._finish(*window.popleft(), on_result)
+                if done.empty():
+                    # Nothing else is arriving right now; do not hold results back
+                    while window:
+                        self._finish(*window.popleft(), on_result)
+            while window:
+                self._finish(*window.popleft(), on_result)
+
+    def _page_count(self, file_path) -> int:
+        try:
+            return self.processor.image_processor.page_count(file_path)
+        except Exception:
+            # Let the decode stage report the unreadable file
+            return 1
+
+    def _join_pages(self, pages: list) -> WorkItem:
+        """ One item for a whole document from its pages, in page order
+
+        The document fails if any page did. Its info and timings sum the
+        additive values of its pages and average the rest.
+        """
+        first = pages[0]
+        document = WorkItem(first.index, first.file_path, first.file_index)
+        document.started = first.started
+        document.cache_key = first.cache_key
+        document.output_path = Path(first.file_path)
+        failed = [page for page in pages if page.error]
+        if failed:
+            document.error = RuntimeError(
+                f"{len(failed)} of {len(pages)} pages failed, page {failed[0].page + 1}: {failed[0].error}"
+            )
+        elif any(page.result for page in pages):
+            document.result = PAGE_SEPARATOR.join((page.result or "").rstrip() for page in pages)
+        elif all("skipped" in page.info for page in pages):
+            document.info["skipped"] = pages[0].info["skipped"]
+        for joined, name in ((document.info, "info"), (document.timings, "timings")):
+            values = {}
+            for page in pages:
+                for key, value in getattr(page, name).items():
+                    if isinstance(value, (int, float)):
+                        values.setdefault(key, []).append(value)
+            for key, numbers in values.items():
+                if _additive(key):
+                    joined[key] = sum(numbers)
+                elif all(isinstance(number, int) for number in numbers):
+                    joined[key] = round(sum(numbers) / len(numbers))
+                else:
+                    joined[key] = sum(numbers) / len(numbers)
+        document.info["pages"] = len(pages)
+        return document
+
+    def status(self, item: WorkItem) -> str:
+        """ failed, cached, skipped, duplicate, done or empty for a finished item
+        """
+        if item.error:
+            return "failed"
+        if item.cached:
+            return "cached"
+        if "skipped" in item.info:
+            return "skipped"
+        if "duplicate_of" in item.info:
+            return "duplicate"
+        return "done" if item.result else "empty"
+
+    def run(self, file_list: Iterable, on_result: Optional[Callable] = None,
+            on_token: Optional[Callable] = None, schedule: Optional[Callable] = None):
+        """ Process files through the pipeline
+
+        on_result(item) is called with each WorkItem from the writer thread,
+        in input order, once its result has been saved. When the processor
+        streams, on_token(item, text) is called from the network threads as
+        text arrives. schedule(file_index) is asked between the pages of a
+        document whether to feed them on (None), feed the next file of
+        file_list first ("yield") or fail the rest of them unsent ("drop").
+        """
+        self._stop.clear()
+        self.processor.abort.clear()
+        if self.dedup:
+            self._settings_key = self.dedup.settings_key(self.processor.settings())
+        tiling = None
+        if self.processor.tile_size:
+            tiling = (self.processor.tile_size, self.processor.tile_overlap, self.processor.page_dimension)
+        ready = queue.Queue(maxsize=self.prefetch)
+        done = queue.Queue()
+        with self._make_decoder() as decoder, self._make_raw_decoder() as raw_decoder:
+            workers = [
+                threading.Thread(target=self._network_worker, args=(ready, done, on_token), daemon=True)
+                for _ in range(self.concurrency)
+            ]
+            writer = threading.Thread(target=self._writer, args=(done, on_result), daemon=True)
+            for thread in workers + [writer]:
+                thread.start()
+            try:
+                self._feed(file_list, schedule, ready, done, decoder, raw_decoder, tiling)
+            finally:
+                for _ in workers:
+                    ready.put(None)
+                for thread in workers:
+                    thread.join()
+                done.put(None)
+                writer.join()
+
+    def _feed(self, file_list: Iterable, schedule: Optional[Callable], ready: queue.Queue,
+              done: queue.Queue, decoder, raw_decoder, tiling):
+        """ Queue files for decoding, each page of a document as its own item
+        """
+        cache = self.processor.cache
+        files = enumerate(file_list)
+        listed = False
+        index = 0
+        # [first page, next page] of the documents being fed, innermost last
+        documents = []
+        while not self._stop.is_set():
+            if documents:
+                first, page = documents[-1]
+                action = schedule(first.file_index) if schedule else None
+                if action != "yield" or listed:
+                    item = WorkItem(index, first.file_path, first.file_index)
+                    index += 1
+                    item.cache_key = first.cache_key
+                    item.page, item.pages = page, first.pages
+                    if page + 1 < first.pages:
+                        documents[-1][1] = page + 1
+                    else:
+                        documents.pop()
+                    if action == "drop":
+                        item.error = RuntimeError("cancelled")
+                        done.put(item)
+                    else:
+                        self._queue(item, decoder, raw_decoder, tiling, ready)
+                    continue
+            try:
+                file_index, file_path = next(files)
+            except StopIteration:
+                if not documents:
+                    break
+                listed = True
+                continue
+            item = WorkItem(index, file_path, file_index)
+            index += 1
+            if self.journal:
+                self.journal.record(file_path, "pending")
+            if cache:
+                try:
+                    item.cache_key = self.processor.cache_key(file_path)
+                    item.result = cache.get(item.cache_key)
+                except Exception as e:
+                    item.error = e
+                if item.result is not None or item.error is not None:
+                    item.cached = item.result is not None
+                    item.output_path = Path(file_path)
+                    done.put(item)
+                    continue
+            pages = self._page_count(file_path)
+            if pages > 1:
+                item.page, item.pages = 0, pages
+                documents.append([item, 1])
+            self._queue(item, decoder, raw_decoder, tiling, ready)
+
+    def _queue(self, item: WorkItem, decoder, raw_decoder, tiling, ready: queue.Queue):
+        item.future = self._submit(decoder, raw_decoder, item.file_path, tiling, item.page)
+        self.stats["decode"].observe_depth(ready.qsize())
+        # Blocks once `prefetch` decoded images are waiting for the
+        # network stage, so pages are only rendered as they are needed
+        ready.put(item)
+
+    def report(self) -> str:
+        """ One line per stage; a network stage with high wait_s is starved by decode
+        """
+        lines = []
+        if "tokens" in self.totals:
+            sent = self.stats["decode"].count
+            lines.append(
+                f"  images: ~{int(self.totals['tokens'])} vision tokens estimated"
+                f" ({self.totals['tokens'] / max(1, sent):.0f} per image)"
+            )
+        if "ttft" in self.totals:
+            streamed = self.stats["network"].count
+            lines.append(
+                f"  stream: mean ttft {1000 * self.totals['ttft'] / max(1, streamed):.0f} ms, "
+                f"{self.totals.get('completion_tokens', 0) / max(1e-9, self.totals.get('generation', 0)):.1f} tokens/s"
+            )
+        if "tokens_saved" in self.totals or "budget_retries" in self.totals:
+            lines.append(
+                f"  answer: {int(self.totals.get('tokens_saved', 0))} tokens saved against max_tokens, "
+                f"{int(self.totals.get('early_stops', 0))} answers stopped early, "
+                f"{int(self.totals.get('budget_retries', 0))} asked again with the full budget"
+            )
+        if "batches" in self.totals or "batch_fallbacks" in self.totals:
+            lines.append(
+                f"   batch: {int(self.totals.get('batched', 0))} images in {int(self.totals.get('batches', 0))} requests, "
+                f"{int(self.totals.get('batch_fallbacks', 0))} batches fell back to single requests"
+            )
+        if "calls_avoided" in self.totals:
+            labels = sorted(key for key in self.totals if key.startswith("skipped_"))
+            lines.append(
+                f"  triage: {int(self.totals['calls_avoided'])} model calls avoided ("
+                + ", ".join(f"{int(self.totals[key])} {key[8:]}" for key in labels) + ")"
+            )
+        if "duplicates" in self.totals:
+            lines.append(f"   dedup: {int(self.totals['duplicates'])} near-duplicates reused a result")
+        if "raw_developed" in self.totals or "raw_reused" in self.totals:
+            lines.append(
+                f"     raw: {int(self.totals.get('raw_developed', 0))} developed in "
+                f"{self.totals.get('demosaic_ms', 0) / 1000:.2f} s, {int(self.totals.get('raw_reused', 0))} reused, "
+                f"peak {self.raw_memory.peak / 2 ** 20:.0f} of {self.raw_memory.limit / 2 ** 20:.0f} MB estimated memory"
+            )
+        if "payload_bytes" in self.totals:
+            source, payload = self.totals.get("source_bytes", 0), self.totals["payload_bytes"]
+            lines.append(
+                f" payload: {payload / 1e6:.1f} MB sent for {source / 1e6:.1f} MB of source files"
+                f" ({100 * payload / max(1, source):.0f}% of their size), "
+                f"{int(self.totals.get('passthrough', 0))} passed through, "
+                f"encode {self.totals.get('encode_ms', 0) / 1000:.2f} s"
+            )
+        for stats in self.stats.values():
+            s = stats.summary()
+            lines.append(
+                f"{s['stage']:>8}: {s['count']} done, {s['errors']} errors, "
+                f"mean {s['mean_ms']} ms, max {s['max_ms']} ms, waited {s['wait_s']} s, "
+                f"queue mean {s['mean_depth']} max {s['max_depth']}"
+            )
+        return "\n".join(lines)
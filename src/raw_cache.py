@@ -0,0 +1,57 @@
+import hashlib
+import os
+import tempfile
+from typing import Optional
+
+from PIL import Image
+
+from result_writer import file_mode
+
+
+class RawCache:
+    """ Directory of developed RAW images so each file is demosaiced only once
+
+    Entries are JPEGs named after a hash of the RAW file's path, size and
+    modification time plus the demosaic mode, so an edited or replaced file
+    is developed again. Writes go through a temporary file and a rename, which
+    keeps the cache safe to share between decode processes.
+    """
+    def __init__(self, directory: str, quality: int = 95):
+        self.directory = directory
+        self.quality = quality
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, file_path, mode: str) -> str:
+        stat = os.stat(file_path)
+        identity = f"{os.path.abspath(file_path)}\0{stat.st_size}\0{stat.st_mtime_ns}\0{mode}"
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.jpg")
+
+    def get(self, key: str, min_dimension: int = 0) -> Optional[Image.Image]:
+        """ The cached development, if its longest side is at least min_dimension
+        """
+        try:
+            img = Image.open(self._path(key))
+        except OSError:
+            return None
+        if max(img.size) < min_dimension:
+            img.close()
+            return None
+        img.load()
+        return img
+
+    def put(self, key: str, img: Image.Image):
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                img.convert("RGB").save(f, format="JPEG", quality=self.quality)
+            # Readable like any other file, for a cache shared between users
+            os.chmod(tmp, file_mode(self._path(key)))
+            os.replace(tmp, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+
+# Read once at import, before any threads: os.umask can only be read by setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def file_mode(path: str) -> int:
+    """ Permissions for a file replacing path: those of the file already
+        there, else what open() would give a new file
+    """
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        return 0o666 & ~_UMASK
+
+
+def write_atomic(path: str, text: str):
+    """ Write text to path through a temporary file in the same directory
+
+    The rename is atomic, so readers (and an interrupted run) only ever see
+    the old file or the complete new one. mkstemp creates the temporary
+    file owner-only, so it is given the permissions a plain write would
+    have left before the rename.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.chmod(tmp, file_mode(path))
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def file_sha256(file_path) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class JsonLinesOutput:
+    """ All results of a batch appended to one JSON lines file
+
+    Replaces the .txt sidecars so downstream indexing reads one file instead
+    of walking a tree. Each line has the source path, its SHA-256, the
+    instruction, the text and the file's timings. Lines are buffered and
+    flushed every `flush_every` results or `flush_seconds`, and on close; a
+    run killed mid-write can leave a truncated last line, which readers
+    should skip.
+    """
+    def __init__(self, path: str, flush_every: int = 100, flush_seconds: float = 5.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.written = 0
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+        self._file = open(path, "a", encoding="utf-8", buffering=1024 * 1024)
+        self._lock = threading.Lock()
+
+    def write(self, file_path, text: str, instruction: str, timings: Optional[dict] = None):
+        try:
+            sha256 = file_sha256(file_path)
+        except OSError:
+            sha256 = None
+        record = {
+            "path": str(file_path),
+            "sha256": sha256,
+            "instruction": instruction,
+            "text": text,
+            "timings": {
+                key: (str(value) if isinstance(value, Path) else value)
+                for key, value in (timings or {}).items()
+            },
+        }
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self.written += 1
+            self._unflushed += 1
+            now = time.monotonic()
+            if self._unflushed >= self.flush_every or now - self._last_flush >= self.flush_seconds:
+                self._file.flush()
+                self._unflushed = 0
+                self._last_flush = now
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def report(self) -> str:
+        return f"  output: {self.written} results in {self.path}"
@@ -0,0 +1,499 @@
+import heapq
+import hmac
+import ipaddress
+import itertools
+import json
+import os
+import queue
+import secrets
+import signal
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+from urllib.parse import parse_qs, urlparse
+
+from file_source import iter_files
+from metrics import Metrics
+
+
+class Job:
+    """ One submitted batch of paths, its results and where it stands
+
+    Paths are expanded lazily as the job is scheduled, like on the command
+    line, so `listed` only turns true once the last file has been taken.
+    """
+    def __init__(self, files: Iterator, priority: int, seq: int):
+        self.id = uuid.uuid4().hex[:12]
+        self.priority = priority
+        self.seq = seq
+        self.files = files
+        self.next = None
+        self.listed = False
+        self.sent = 0
+        self.results = []
+        self.counts = {}
+        self.cancelled = False
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # Spans of this job's files only
+        self.metrics = Metrics()
+        # Queues of clients streaming this job's events
+        self.listeners = []
+
+    def advance(self):
+        """ Look one file ahead, so the job knows when it has been listed """
+        try:
+            self.next = next(self.files)
+        except StopIteration:
+            self.next = None
+            self.listed = True
+
+    @property
+    def state(self) -> str:
+        if self.cancelled:
+            return "cancelled"
+        if self.finished is not None:
+            return "done"
+        return "running" if self.started is not None else "queued"
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "state": self.state,
+            "priority": self.priority,
+            "sent": self.sent,
+            "finished_files": len(self.results),
+            "listed": self.listed,
+            "counts": dict(self.counts),
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class Service:
+    """ Resident OCR service: jobs share one long-running Pipeline
+
+    The pipeline's file list never ends; it yields the next file of the
+    highest priority job (oldest first among equals) whenever the decode
+    stage has room, and between the pages of a long document the pipeline
+    asks whether a more urgent job is waiting, so an urgent job overtakes
+    a large batch within `prefetch` pages. The decode processes, the API
+    connections, the result cache and the dedup index stay warm between
+    jobs. Results still leave the pipeline in the order pages were taken,
+    so a job's first result can wait for requests already in flight.
+    Finished jobs, with their results and metrics, are kept for `keep_for`
+    seconds, and only the last `keep_jobs` of them. The processor's own
+    Metrics are rolled over as each job finishes, so a service that runs for
+    months does not keep every span it has seen.
+    """
+    def __init__(self, pipeline, keep_jobs: int = 100, keep_for: float = 3600.0):
+        self.pipeline = pipeline
+        self.keep_jobs = keep_jobs
+        self.keep_for = keep_for
+        self.jobs = {}
+        self.started = time.time()
+        self._queue = []
+        self._seq = itertools.count()
+        self._index = 0
+        # Jobs of the files in the pipeline, by file_index
+        self._owners = {}
+        self._changed = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+    def submit(self, paths, priority: int = 0, recursive: bool = True, resume: bool = False) -> Job:
+        """ Queue paths (files, directories or globs); higher priority runs first
+        """
+        files = iter_files(paths, self.pipeline.processor.image_processor, recursive)
+        if resume and self.pipeline.journal:
+            files = self.pipeline.journal.remaining(files)
+        job = Job(files, priority, next(self._seq))
+        job.advance()
+        with self._changed:
+            if self._closed:
+                raise RuntimeError("service is shutting down")
+            self._evict()
+            self.jobs[job.id] = job
+            heapq.heappush(self._queue, (-priority, job.seq, job))
+            self._check_done(job)
+            self._changed.notify_all()
+        return job
+
+    def cancel(self, job: Job):
+        """ Take no more files from a job; files already sent still finish,
+            but the pages of a document not yet sent are dropped
+        """
+        with self._changed:
+            if job.finished is None:
+                job.cancelled = True
+                self._check_done(job)
+                self._changed.notify_all()
+
+    def _check_done(self, job: Job):
+        if job.finished is None and (job.listed or job.cancelled) and len(job.results) == job.sent:
+            job.finished = time.time()
+            self._publish(job, {"event": "finished", "job": job.summary()})
+            if self.pipeline.processor.metrics:
+                self.pipeline.processor.metrics.roll()
+            self._evict()
+
+    def _evict(self):
+        finished = sorted(
+            (job for job in self.jobs.values() if job.finished is not None), key=lambda job: job.finished
+        )
+        expired = time.time() - self.keep_for
+        for n, job in enumerate(finished):
+            if job.finished < expired or n < len(finished) - self.keep_jobs:
+                del self.jobs[job.id]
+
+    def _publish(self, job: Job, event: dict):
+        for listener in job.listeners:
+            listener.put(event)
+
+    def _next_job(self) -> Optional[Job]:
+        while self._queue:
+            job = self._queue[0][2]
+            if not job.cancelled and job.next is not None:
+                return job
+            heapq.heappop(self._queue)
+        return None
+
+    def _files(self) -> Iterator[str]:
+        """ The pipeline's endless file list, blocking while no job has files
+        """
+        while True:
+            with self._changed:
+                job = self._next_job()
+                while job is None and not self._closed:
+                    self._changed.wait()
+                    job = self._next_job()
+                if self._closed:
+                    return
+                path = job.next
+                job.next = None
+                job.sent += 1
+                if job.started is None:
+                    job.started = time.time()
+                self._owners[self._index] = job
+                self._index += 1
+            # Walking a large directory happens here, outside the lock, and
+            # only this thread advances a job once it is queued
+            job.advance()
+            with self._changed:
+                self._check_done(job)
+            yield path
+
+    def _schedule(self, file_index: int) -> Optional[str]:
+        """ Between the pages of a document: drop the rest if its job was
+            cancelled, yield to a job of higher priority
+        """
+        with self._changed:
+            job = self._owners[file_index]
+            if job.cancelled:
+                return "drop"
+            waiting = self._next_job()
+            if waiting is not None and waiting.priority > job.priority:
+                return "yield"
+        return None
+
+    def _on_token(self, item, text: str):
+        with self._changed:
+            job = self._owners.get(item.file_index)
+            if job:
+                self._publish(job, {"event": "token", "path": str(item.file_path), "page": item.page, "text": text})
+
+    def _on_result(self, item):
+        status = self.pipeline.status(item)
+        result = {"path": str(item.file_path), "status": status}
+        if item.error:
+            result["error"] = str(item.error)
+        elif "skipped" in item.info:
+            result["skipped"] = item.info["skipped"]
+        else:
+            result["text"] = item.result or ""
+        job = self._owners[item.file_index]
+        job.metrics.record(
+            item.file_path, status, item.info, item.timings,
+            duration_ms=1000 * (time.perf_counter() - item.started),
+            error=str(item.error) if item.error else None,
+        )
+        with self._changed:
+            del self._owners[item.file_index]
+            job.results.append(result)
+            job.counts[status] = job.counts.get(status, 0) + 1
+            self._publish(job, dict(result, event="result"))
+            self._check_done(job)
+            self._changed.notify_all()
+
+    def events(self, job: Job, since: int = 0) -> Iterator[dict]:
+        """ Results from `since` on, then tokens and results as they arrive,
+            ending with a finished event
+        """
+        listener = queue.Queue()
+        with self._changed:
+            backlog = job.results[since:]
+            finished = job.finished is not None
+            if not finished:
+                job.listeners.append(listener)
+        for result in backlog:
+            yield dict(result, event="result")
+        if finished:
+            yield {"event": "finished", "job": job.summary()}
+            return
+        try:
+            while True:
+                event = listener.get()
+                yield event
+                if event["event"] == "finished":
+                    return
+        finally:
+            with self._changed:
+                job.listeners.remove(listener)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        self.pipeline.run(self._files(), self._on_result, self._on_token, self._schedule)
+
+    def close(self, cancel: bool = False):
+        """ Stop taking files and wait for the pipeline to drain; with cancel,
+            requests in flight are aborted
+        """
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+        if cancel:
+            self.pipeline.stop(cancel=True)
+        if self._thread:
+            self._thread.join()
+
+    def summaries(self) -> list:
+        with self._changed:
+            self._evict()
+            return [job.summary() for job in self.jobs.values()]
+
+    def health(self) -> dict:
+        with self._changed:
+            states = {}
+            for job in self.jobs.values():
+                states[job.state] = states.get(job.state, 0) + 1
+            in_flight = len(self._owners)
+        return {"status": "ok", "uptime": round(time.time() - self.started, 1), "jobs": states, "in_flight": in_flight}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ JSON API of a Service
+
+    POST   /jobs              {"paths": [...], "priority": 0, "recursive": true, "resume": false}
+    GET    /jobs              summaries of the jobs kept
+    GET    /jobs/ID?since=N   summary, metrics and results from the Nth on
+    GET    /jobs/ID/events    JSON lines of results (and tokens when streaming) until it finishes
+    DELETE /jobs/ID           cancel
+    GET    /health, /report
+
+    When the server has a token, every request must carry it as
+    "Authorization: Bearer TOKEN".
+    """
+    def _send_json(self, status: int, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status: int, message: str):
+        self._send_json(status, {"error": message})
+
+    def _authorized(self) -> bool:
+        token = self.server.token
+        if token is None:
+            return True
+        given = self.headers.get("Authorization", "")
+        if hmac.compare_digest(given.encode("utf-8"), f"Bearer {token}".encode("utf-8")):
+            return True
+        self._error(401, "missing or wrong token")
+        return False
+
+    def _job(self, job_id: str) -> Optional[Job]:
+        job = self.server.service.jobs.get(job_id)
+        if job is None:
+            self._error(404, f"no job {job_id}")
+        return job
+
+    def _route(self):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        query = parse_qs(url.query)
+        return parts, query
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        service = self.server.service
+        parts, query = self._route()
+        if parts == ["health"]:
+            return self._send_json(200, service.health())
+        if parts == ["report"]:
+            pipeline = service.pipeline
+            lines = [pipeline.report(), pipeline.processor.client.report()]
+            if pipeline.processor.cache:
+                lines.append(pipeline.processor.cache.report())
+            return self._send_json(200, {"report": "\n".join(lines)})
+        if parts == ["jobs"]:
+            return self._send_json(200, service.summaries())
+        if len(parts) not in (2, 3) or parts[0] != "jobs" or (len(parts) == 3 and parts[2] != "events"):
+            return self._error(404, f"no route {url_path(parts)}")
+        job = self._job(parts[1])
+        if job is None:
+            return
+        try:
+            since = max(0, int(query.get("since", ["0"])[0]))
+        except ValueError:
+            return self._error(400, "since must be a number")
+        if len(parts) == 2:
+            with service._changed:
+                body = dict(job.summary(), metrics=job.metrics.summary(), results=job.results[since:])
+            return self._send_json(200, body)
+        # No Content-Length: the stream ends when the connection closes
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            for event in service.events(job, since):
+                self.wfile.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        parts, _ = self._route()
+        if parts != ["jobs"]:
+            return self._error(404, f"no route {url_path(parts)}")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            paths = body["paths"]
+            if isinstance(paths, str):
+                paths = [paths]
+            if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+                raise ValueError("paths must be a list of strings")
+            priority = int(body.get("priority", 0))
+        except (KeyError, ValueError, TypeError) as e:
+            return self._error(400, f"bad job: {e}")
+        try:
+            job = self.server.service.submit(
+                paths, priority, bool(body.get("recursive", True)), bool(body.get("resume", False))
+            )
+        except RuntimeError as e:
+            return self._error(503, str(e))
+        self._send_json(201, job.summary())
+
+    def do_DELETE(self):
+        if not self._authorized():
+            return
+        parts, _ = self._route()
+        if len(parts) != 2 or parts[0] != "jobs":
+            return self._error(404, f"no route {url_path(parts)}")
+        job = self._job(parts[1])
+        if job is not None:
+            self.server.service.cancel(job)
+            self._send_json(200, job.summary())
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_request(self, code="-", size="-"):
+        # Clients poll; only errors are logged
+        pass
+
+
+def url_path(parts) -> str:
+    return "/" + "/".join(parts)
+
+
+def is_loopback(host: str) -> bool:
+    """ Whether every address host resolves to is on this machine only
+    """
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except OSError:
+        return False
+    # Scoped IPv6 addresses carry a %interface suffix
+    return bool(addresses) and all(ipaddress.ip_address(a.split("%")[0]).is_loopback for a in addresses)
+
+
+# Windows has no Unix sockets
+if hasattr(socketserver, "UnixStreamServer"):
+    class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+else:
+    _UnixHTTPServer = None
+
+
+def serve(pipeline, host: str = "127.0.0.1", port: Optional[int] = None, socket_path: Optional[str] = None,
+          token: Optional[str] = None, allow_remote: bool = False):
+    """ Run a Service for pipeline over HTTP on host:port or a Unix socket
+        until interrupted, then let the files in flight finish
+
+    Any client can have the service read and return the user's files, so
+    HTTP always needs a token (a random one is made and printed if none is
+    given) and only listens beyond this machine with allow_remote. The Unix
+    socket is only accessible to its owner and needs a token only if given.
+    """
+    if socket_path and _UnixHTTPServer is None:
+        raise OSError("Unix sockets are not supported on this platform")
+    if not socket_path and not allow_remote and not is_loopback(host):
+        raise ValueError(f"{host} is reachable from other machines; allow remote clients explicitly")
+    service = Service(pipeline)
+    if socket_path:
+        if os.path.exists(socket_path):
+            # Left behind by a service that was killed
+            os.remove(socket_path)
+        # Created owner-only, so no other user can connect before a chmod
+        umask = os.umask(0o177)
+        try:
+            server = _UnixHTTPServer(socket_path, _Handler)
+        finally:
+            os.umask(umask)
+        where = socket_path
+    else:
+        if token is None:
+            token = secrets.token_urlsafe(24)
+            print(f"Token: {token}")
+        server = ThreadingHTTPServer((host, port), _Handler)
+        server.daemon_threads = True
+        where = f"http://{host}:{server.server_address[1]}"
+    server.service = service
+    server.token = token
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    # Stopped as a daemon, shut down as on Ctrl+C
+    signal.signal(signal.SIGTERM, terminate)
+    service.start()
+    print(f"Serving on {where}, Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping, waiting for files in flight")
+    finally:
+        server.server_close()
+        service.close()
+        if socket_path:
+            try:
+                os.remove(socket_path)
+            except OSError:
+                pass
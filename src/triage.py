@@ -0,0 +1,99 @@
+from typing import Tuple
+
+from PIL import Image
+
+# Steps between neighbouring gray levels at least this large are edges
+EDGE_STEP = 48
+# Pixels this far from the background gray are ink
+INK_STEP = 64
+# Side of the square cells text is looked for in
+CELL = 16
+# Least edge pixels per ink pixel in a cell of thin strokes
+STROKE_RATIO = 0.5
+
+
+class Triage:
+    """ Cheap local check of whether an image is worth a model call
+
+    Works on a grayscale copy of the resized image with a few vectorized
+    statistics:
+
+    contrast:   standard deviation of the gray levels
+    ink:        fraction of pixels far from the background (the median gray)
+    edges:      fraction of pixels with a sharp step to a neighbour
+    text_cells: number of 16 x 16 cells that look like print, i.e. thin
+                sharp strokes both across and down on mostly background,
+                next to another such cell
+
+    An image with hardly any ink or edges is blank when its contrast is low
+    and low_text otherwise (smooth photos, gradients). One with edges but
+    no cells that look like print (photos, drawings, a separator sheet with
+    a box or logo, dust and punch holes) is low_text too. A single short
+    line of text is enough to count as text, so only images that are very
+    likely empty of text are skipped.
+    """
+    labels = ("blank", "low_text", "text")
+
+    def __init__(self, min_contrast: float = 8.0, min_ink: float = 0.00005, min_edges: float = 0.00005,
+                 min_text_cells: int = 2, cell_edges: float = 0.03, cell_background: float = 0.4,
+                 skip: Tuple[str, ...] = ("blank", "low_text")):
+        unknown = set(skip) - set(self.labels)
+        if unknown:
+            raise ValueError(f"Unknown triage labels: {', '.join(sorted(unknown))}")
+        self.min_contrast = min_contrast
+        self.min_ink = min_ink
+        self.min_edges = min_edges
+        self.min_text_cells = min_text_cells
+        self.cell_edges = cell_edges
+        self.cell_background = cell_background
+        self.skip = tuple(skip)
+
+    def measure(self, img: Image.Image) -> dict:
+        # Imported here so runs without triage do not pay for NumPy
+        import numpy as np
+        gray = np.asarray(img.convert("L"), dtype=np.int16)
+        background = int(np.median(gray))
+        distance = np.abs(gray - background)
+        across = np.zeros(gray.shape, dtype=bool)
+        across[:, :-1] = np.abs(np.diff(gray, axis=1)) >= EDGE_STEP
+        down = np.zeros(gray.shape, dtype=bool)
+        down[:-1, :] = np.abs(np.diff(gray, axis=0)) >= EDGE_STEP
+        steps = across | down
+        # Cell statistics by reshaping the cropped image into CELL x CELL blocks
+        rows, cols = gray.shape[0] // CELL, gray.shape[1] // CELL
+        text_cells = 0
+        if rows and cols:
+            def per_cell(values):
+                cropped = values[:rows * CELL, :cols * CELL]
+                return cropped.reshape(rows, CELL, cols, CELL).mean(axis=(1, 3))
+            # Glyphs have strokes both ways, unlike ruled lines and box edges,
+            # and thin ones, so about as many edge pixels as ink pixels,
+            # unlike filled shapes such as punch holes
+            print_like = (
+                (np.minimum(per_cell(across), per_cell(down)) >= self.cell_edges)
+                & (per_cell(distance <= INK_STEP // 2) >= self.cell_background)
+                & (per_cell(steps) >= STROKE_RATIO * per_cell(distance > INK_STEP))
+            )
+            # Print runs along lines; a lone cell is more likely a speck of dust
+            beside = np.zeros_like(print_like)
+            beside[:, 1:] |= print_like[:, :-1]
+            beside[:, :-1] |= print_like[:, 1:]
+            text_cells = int(np.count_nonzero(print_like & beside))
+        return {
+            "contrast": round(float(gray.std()), 2),
+            "ink": round(float(np.count_nonzero(distance > INK_STEP)) / gray.size, 6),
+            "edges": round(float(np.count_nonzero(steps)) / gray.size, 6),
+            "text_cells": text_cells,
+        }
+
+    def classify(self, img: Image.Image) -> Tuple[str, dict]:
+        """ Label an image blank, low_text or text, with the statistics used
+        """
+        stats = self.measure(img)
+        if stats["ink"] < self.min_ink and stats["edges"] < self.min_edges:
+            label = "blank" if stats["contrast"] < self.min_contrast else "low_text"
+        elif stats["text_cells"] < self.min_text_cells:
+            label = "low_text"
+        else:
+            label = "text"
+        return label, stats